@@ -15,12 +15,13 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
-from datetime import datetime
 
 from gi.repository import GObject, Gio, Gtk
 
 import fit
 import strava
+import simplify
+import utils
 
 class Activity(GObject.GObject):
 
@@ -42,13 +43,19 @@ class Activity(GObject.GObject):
         self.fit = None
         self.status = Activity.Status.NONE
         self.uploader = None
+        self.route_future = None
+        # the device job downloading this activity, which could be
+        # downloading others too
+        self.download_job = None
 
         self.setup_fit()
 
     def setup_fit(self):
         if self.downloaded:
             self.fit = fit.Fit(self.full_path)
+            self.route_future = None
             self.fit.connect('status-changed', self.fit_status_changed_cb)
+            self.fit.connect('summary-parsed', self.fit_summary_parsed_cb)
             self.status = Activity.Status.DOWNLOADED
 
     def fit_status_changed_cb(self, f, status):
@@ -62,20 +69,21 @@ class Activity(GObject.GObject):
             if status == fstatus:
                 self.change_status(astatus)
 
-        # cache a bit of information
         if status == fit.Fit.Status.PARSED:
-            if self.fit.get_sport():
-                # string
-                self.set_config('sport', self.fit.get_sport())
-                # float
-                self.set_config('distance', self.fit.get_distance())
-                # float
-                self.set_config('elapsed_time',
-                    self.fit.get_elapsed_time(triplet=False))
-                # string
-                start_time = self.fit.get_start_time()
-                self.set_config('start_time',
-                    start_time.strftime('%Y-%m-%d %H:%M:%S'))
+            self.cache_summary()
+
+    def fit_summary_parsed_cb(self, f):
+        self.cache_summary()
+        self.emit('summary-updated')
+
+    def cache_summary(self):
+        # cache a bit of information
+        if self.fit.get_sport():
+            self.app.index.update(self.filename,
+                sport=self.fit.get_sport(),
+                distance=self.fit.get_distance(),
+                elapsed_time=self.fit.get_elapsed_time(triplet=False),
+                start_time=self.fit.get_start_time())
 
     # signals: because GObject doesn't support multiple inheritance, every
     # signal here will have to be copied into any subclass manually
@@ -90,21 +98,14 @@ class Activity(GObject.GObject):
         # change the text on one button.
         pass
 
-    @GObject.Signal(arg_types=(float,))
-    def download_progress(self, fraction):
+    @GObject.Signal(arg_types=(float, float, float))
+    def download_progress(self, fraction, rate, eta):
+        # rate in bytes per second, eta in seconds or -1 if unknown
         pass
 
-    # config options
-    def get_config(self, key, default=None):
-        if self.app.config.has_option(self.filename, key):
-            return self.app.config.get(self.filename, key)
-        return default
-
-    def set_config(self, key, value):
-        if not self.app.config.has_section(self.filename):
-            self.app.config.add_section(self.filename)
-        self.app.config.set(self.filename, key, value)
-        self.app.config.save()
+    @GObject.Signal
+    def summary_updated(self):
+        pass
 
     # properties
     @property
@@ -122,16 +123,24 @@ class Activity(GObject.GObject):
 
     @property
     def downloaded(self):
-        return os.path.exists(self.full_path)
+        # worked out when the file list was fetched so we don't have to
+        # look at the disk for every activity
+        return self.antfile.downloaded
+
+    @property
+    def needs_summary(self):
+        return self.fit is not None and \
+            self.fit.status == fit.Fit.Status.NONE and \
+            not self.fit.summary_requested and \
+            self.app.index.get(self.filename, 'start_time') is None
 
     @property
     def strava_id(self):
-        ret = self.get_config('strava_id')
-        return ret if ret is None else int(ret)
+        return self.app.index.get(self.filename, 'strava_id')
 
     @strava_id.setter
     def strava_id(self, new_id):
-        self.set_config('strava_id', str(new_id))
+        self.app.index.update(self.filename, strava_id=new_id)
         self.emit('strava-id-updated', new_id)
 
     @property
@@ -139,10 +148,8 @@ class Activity(GObject.GObject):
         if self.status == Activity.Status.PARSED:
             return self.fit.get_start_time()
         else:
-            start = self.get_config('start_time')
-            if start:
-                return datetime.strptime(start, '%Y-%m-%d %H:%M:%S')
-            return self.antfile.save_date
+            return self.app.index.get(self.filename, 'start_time',
+                self.antfile.save_date)
 
     @property
     def sport(self):
@@ -150,7 +157,7 @@ class Activity(GObject.GObject):
             return self.fit.get_sport()
 
         # will default to None
-        return self.get_config('sport')
+        return self.app.index.get(self.filename, 'sport')
 
     # helper funcs
     def change_status(self, status):
@@ -168,10 +175,46 @@ class Activity(GObject.GObject):
         else:
             return 0
 
+    def check_file(self):
+        # the snapshot can't know if the file has been deleted since it
+        # was taken, so look just before it's opened rather than
+        # stat'ing every file when listing
+        if self.status == Activity.Status.DOWNLOADED and \
+           not os.path.exists(self.full_path):
+            self.antfile.downloaded = False
+            self.fit = None
+            self.change_status(Activity.Status.NONE)
+
     def parse(self):
         # deliberately break if self.fit is None
         self.fit.parse()
 
+    def parse_summary(self):
+        self.fit.parse_summary()
+
+    def load_route(self):
+        # simplifying is only done once per activity
+        if self.route_future is None:
+            self.route_future = self.build_route()
+        return self.route_future
+
+    @utils.run_in_pool('parse')
+    def build_route(self):
+        return simplify.Route(*self.fit.track().positions())
+
+    def apply_parse_result(self, summary, columns):
+        # from a BulkParser; columns is None if only the summary was
+        # wanted.
+        self.fit.summary_requested = True
+
+        if columns is not None:
+            self.fit.load(summary, columns)
+        elif summary is not None:
+            if self.fit.summary is None:
+                self.fit.summary = summary
+            self.cache_summary()
+            self.emit('summary-updated')
+
     def upload(self):
         if self.uploader:
             return self.uploader
@@ -194,29 +237,61 @@ class Activity(GObject.GObject):
         return self.uploader
 
     def download(self):
-        if self.downloaded:
+        # the file might have been removed since the snapshot was taken
+        if self.downloaded and os.path.exists(self.full_path):
             return
 
         if self.status == Activity.Status.DOWNLOADING:
             return
 
-        def progress_cb(fraction):
-            self.emit('download-progress', fraction)
+        def progress_cb(fraction, rate, eta):
+            self.emit('download-progress', fraction, rate, eta)
 
-        self.app.queue.download_file(self.file_downloaded_cb,
-            self.antfile, progress_cb)
+        self.download_job = self.app.queue.download_file(
+            self.file_downloaded_cb, self.antfile, progress_cb)
 
         self.change_status(Activity.Status.DOWNLOADING)
 
-    def file_downloaded_cb(self, data):
-        if not data:
-            self.change_status(Activity.Status.DOWNLOAD_FAILED)
+    def cancel_download(self):
+        if self.status != Activity.Status.DOWNLOADING:
+            return
+
+        if self.download_job:
+            self.app.queue.cancel(self.download_job, self.antfile)
+            self.download_job = None
+
+        self.change_status(Activity.Status.NONE)
+
+    def file_downloaded_cb(self, result):
+        # the file is written into place by the device thread so there's
+        # nothing left to do but start using it. if it was cancelled
+        # but finished anyway we might as well keep it.
+        if not result:
+            if self.status == Activity.Status.DOWNLOADING:
+                self.download_job = None
+                self.change_status(Activity.Status.DOWNLOAD_FAILED)
+            return
+
+        if self.status not in (Activity.Status.NONE,
+                               Activity.Status.DOWNLOADING):
             return
 
-        with open(self.full_path, 'wb') as f:
-            f.write(data)
+        path, size, parsed = result
+        utils.debug('activity: {} downloaded, {} bytes', path, size)
+
+        self.download_job = None
+        self.antfile.set_downloaded()
         self.setup_fit()
-        self.change_status(Activity.Status.DOWNLOADED)
+
+        # if it's being looked at it's already being parsed from the
+        # download buffer so take that, and cache its summary, as soon
+        # as it's done. otherwise the list only needs the summary.
+        if parsed is not None:
+            self.fit.parse_from(parsed)
+        else:
+            self.change_status(Activity.Status.DOWNLOADED)
+            if self.fit.status == fit.Fit.Status.NONE:
+                self.parse_summary()
 
         recent = Gtk.RecentManager()
         recent.add_item(self.uri)
@@ -0,0 +1,126 @@
+# Copyright (C) 2015 Jonny Lamb <jonnylamb@jonnylamb.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+
+import utils
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS activities (
+    filename TEXT PRIMARY KEY,
+    sport TEXT,
+    distance REAL,
+    elapsed_time REAL,
+    start_time TIMESTAMP,
+    strava_id INTEGER
+)
+'''
+
+COLUMNS = ('sport', 'distance', 'elapsed_time', 'start_time', 'strava_id')
+
+class ActivityIndex(object):
+    """Cached metadata about each activity, keyed by FIT filename.
+
+    Every row is kept in memory so lookups don't touch the disk;
+    writes go straight to the database, grouped into one transaction
+    per update() or per batch()."""
+
+    def __init__(self, path):
+        utils.makedirs(os.path.dirname(path))
+
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+        self.rows = {}
+        for row in self.db.execute('SELECT * FROM activities'):
+            values = dict((key, row[key]) for key in COLUMNS)
+            # converted by hand rather than with PARSE_DECLTYPES so a
+            # bad value in one row doesn't stop the whole index loading
+            values['start_time'] = utils.parse_timestamp(values['start_time'])
+            self.rows[row['filename']] = values
+
+        self.batching = False
+
+    def migrate(self, config):
+        # activities used to have a section each in fuga.ini
+        sections = [s for s in config.sections() if s.endswith('.fit')]
+        if not sections:
+            return
+
+        with self.batch():
+            for section in sections:
+                values = dict(config.items(section))
+
+                for key in ('distance', 'elapsed_time'):
+                    if key in values:
+                        values[key] = float(values[key])
+                if 'strava_id' in values:
+                    values['strava_id'] = int(values['strava_id'])
+                if 'start_time' in values:
+                    values['start_time'] = utils.parse_timestamp(
+                        values['start_time'])
+
+                self.update(section, **dict((k, v) for (k, v) in
+                    values.items() if k in COLUMNS))
+
+                config.remove_section(section)
+
+        config.save()
+
+    def get(self, filename, key, default=None):
+        value = self.rows.get(filename, {}).get(key)
+        return default if value is None else value
+
+    def __contains__(self, filename):
+        return filename in self.rows
+
+    @contextmanager
+    def batch(self):
+        # nested batches just join the outer transaction
+        if self.batching:
+            yield
+            return
+
+        self.batching = True
+        try:
+            with self.db:
+                yield
+        finally:
+            self.batching = False
+
+    def update(self, filename, **values):
+        # fit gives 0 when there's no start time
+        if 'start_time' in values and \
+           not isinstance(values['start_time'], datetime):
+            values['start_time'] = None
+
+        row = self.rows.setdefault(filename, dict.fromkeys(COLUMNS))
+        row.update(values)
+
+        with self.batch():
+            self.db.execute(
+                'INSERT OR REPLACE INTO activities (filename, {}) '
+                'VALUES (?, {})'.format(', '.join(COLUMNS),
+                                        ', '.join('?' * len(COLUMNS))),
+                [filename] + [row[key] for key in COLUMNS])
+
+    def close(self):
+        self.db.close()
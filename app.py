@@ -15,7 +15,6 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
-from ConfigParser import ConfigParser
 
 from gi.repository import Gtk, GLib, Gio, Gdk
 
@@ -24,8 +23,12 @@ from ui.window import Window
 from fakegarmin import FakeGarmin
 from garmin import Garmin
 from devicequeue import GarminQueue
+from activityindex import ActivityIndex
+from config import Config
+import utils
 
 CONFIG_PATH = os.path.join(GLib.get_user_config_dir(), 'fuga', 'fuga.ini')
+INDEX_PATH = os.path.join(GLib.get_user_data_dir(), 'fuga', 'activities.db')
 
 class Fuga(Gtk.Application):
     def __init__(self):
@@ -36,16 +39,24 @@ class Fuga(Gtk.Application):
 
         self.connect('activate', self.activate_cb)
 
-        self.config = self.create_config()
+        self.config = Config(CONFIG_PATH)
+
+        self.index = ActivityIndex(INDEX_PATH)
+        self.index.migrate(self.config)
 
         ui.style.setup()
 
+        # only worth the wakeups when someone's looking
+        if 'FUGA_DEBUG' in os.environ:
+            self.stall_monitor = utils.StallMonitor()
+            self.stall_monitor.start()
+
         if 'FAKE_GARMIN' in os.environ:
             cls = FakeGarmin
         else:
             cls = Garmin
 
-        self.queue = GarminQueue(cls)
+        self.queue = GarminQueue(cls, self.config)
 
     def activate_cb(self, data=None):
         window = Window(self)
@@ -57,27 +68,10 @@ class Fuga(Gtk.Application):
 
     def window_destroy_cb(self, window):
         self.queue.shutdown()
+        self.config.flush()
 
     def key_press_event_cb(self, window, event):
         if (event.state & Gdk.ModifierType.CONTROL_MASK \
             and event.keyval == Gdk.KEY_q) or \
            event.keyval == Gdk.KEY_Escape:
             window.destroy()
-
-    def create_config(self):
-        path = os.path.dirname(CONFIG_PATH)
-        if not os.path.exists(path):
-            os.mkdir(path)
-
-        config = ConfigParser()
-
-        if os.path.exists(CONFIG_PATH):
-            config.read(CONFIG_PATH)
-
-        def save_config():
-            with open(CONFIG_PATH, 'w') as configfile:
-                config.write(configfile)
-            os.chmod(CONFIG_PATH, 0600)
-        config.save = save_config
-
-        return config
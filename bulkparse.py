@@ -0,0 +1,143 @@
+# Copyright (C) 2015 Jonny Lamb <jonnylamb@jonnylamb.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import time
+import Queue
+import multiprocessing
+from collections import deque
+
+from gi.repository import GLib, GObject
+
+import fit
+import utils
+
+# the worker processes are forked once, from start_workers() before
+# the app has started any threads. forking later, from a thread of a
+# GTK process with a sqlite connection open, can leave the children
+# stuck on a lock some other thread held at the time.
+workers = None
+processes = multiprocessing.cpu_count()
+
+def start_workers():
+    global workers
+    if workers is None:
+        workers = multiprocessing.Pool(processes)
+
+def parse_file(job):
+    # this is run in a worker process so mustn't touch anything but
+    # the file itself. a full decode writes the sidecar as a side
+    # effect so opening the activity later is quick.
+    path, tracks = job
+
+    try:
+        if tracks:
+            summary, columns = fit.load_file(path)
+        else:
+            summary, columns = fit.load_summary(path), None
+    except Exception:
+        return path, None, None
+
+    return path, summary, columns
+
+class BulkParser(GObject.GObject):
+    """Parse lots of activities using the worker processes, applying
+    the results to the activities in the main loop in batches. Only
+    the summaries are read unless tracks is set."""
+
+    BATCH_SIZE = 25
+    BATCH_INTERVAL = 0.25
+
+    @GObject.Signal(arg_types=(int, int))
+    def progress(self, done, total):
+        pass
+
+    @GObject.Signal
+    def finished(self):
+        pass
+
+    def __init__(self, index, activities, tracks=False):
+        GObject.GObject.__init__(self)
+
+        self.index = index
+        self.activities = dict((a.full_path, a) for a in activities)
+        self.tracks = tracks
+
+        self.total = len(self.activities)
+        self.done = 0
+        self.cancelled = False
+
+        self.start_time = None
+
+    def start(self):
+        # should have been done at startup; this is just so it works
+        start_workers()
+
+        self.start_time = time.time()
+        self.feed()
+
+    def cancel(self):
+        self.cancelled = True
+
+    @utils.run_in_thread
+    def feed(self):
+        jobs = deque((path, self.tracks) for path in self.activities)
+        results = Queue.Queue()
+        waiting = 0
+
+        batch = []
+        last = time.time()
+
+        while True:
+            # only hand out a few at a time as the workers are shared
+            # and there's no taking them back once we're cancelled
+            while jobs and waiting < processes * 2 and not self.cancelled:
+                workers.apply_async(parse_file, (jobs.popleft(),),
+                                    callback=results.put)
+                waiting += 1
+
+            if not waiting:
+                break
+
+            try:
+                # don't block forever so we notice being cancelled
+                batch.append(results.get(True, self.BATCH_INTERVAL))
+                waiting -= 1
+            except Queue.Empty:
+                pass
+
+            if len(batch) >= self.BATCH_SIZE or \
+               (batch and time.time() - last > self.BATCH_INTERVAL):
+                GLib.idle_add(self.apply, batch)
+                batch = []
+                last = time.time()
+
+        GLib.idle_add(self.apply, batch, True)
+
+    def apply(self, batch, last=False):
+        with self.index.batch():
+            for path, summary, columns in batch:
+                self.activities[path].apply_parse_result(summary, columns)
+
+        self.done += len(batch)
+        if batch:
+            self.emit('progress', self.done, self.total)
+
+        if last:
+            utils.debug('bulkparse: {} of {} activities in {:.2f}s',
+                self.done, self.total, time.time() - self.start_time)
+            self.emit('finished')
+
+        return False
@@ -0,0 +1,97 @@
+# Copyright (C) 2015 Jonny Lamb <jonnylamb@jonnylamb.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import time
+from ConfigParser import ConfigParser
+
+from gi.repository import GLib
+
+import utils
+
+class Config(ConfigParser):
+    """A ConfigParser which is written back lazily.
+
+    save() only marks the config as dirty; the file is written at most
+    once every FLUSH_INTERVAL seconds, or when flush() is called
+    directly on shutdown."""
+
+    FLUSH_INTERVAL = 2
+
+    def __init__(self, path):
+        ConfigParser.__init__(self)
+
+        self.path = path
+        utils.makedirs(os.path.dirname(path))
+
+        if os.path.exists(path):
+            self.read(path)
+
+        self.dirty = False
+        self.flush_source = 0
+        # saves since the last flush
+        self.pending_saves = 0
+
+        # stats
+        self.save_count = 0
+        self.flush_count = 0
+        self.flush_time = 0.0
+        self.max_flush_time = 0.0
+
+    def save(self):
+        self.save_count += 1
+        self.pending_saves += 1
+        self.dirty = True
+
+        if not self.flush_source:
+            self.flush_source = GLib.timeout_add_seconds(
+                self.FLUSH_INTERVAL, self.flush_timeout_cb)
+
+    def flush_timeout_cb(self):
+        self.flush_source = 0
+        self.flush()
+        return False
+
+    def flush(self):
+        if self.flush_source:
+            GLib.source_remove(self.flush_source)
+            self.flush_source = 0
+
+        if not self.dirty:
+            return
+
+        start = time.time()
+
+        # write to a temporary file and move it over the top so we
+        # never leave a half-written config behind
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as f:
+            self.write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+        self.dirty = False
+
+        elapsed = time.time() - start
+        self.flush_count += 1
+        self.flush_time += elapsed
+        self.max_flush_time = max(self.max_flush_time, elapsed)
+
+        utils.debug('config: flush {} took {:.1f}ms ({} saves coalesced)',
+            self.flush_count, elapsed * 1000, self.pending_saves)
+        self.pending_saves = 0
@@ -14,32 +14,326 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
-from gi.repository import GObject
+import os
+import time
+import heapq
+import threading
+import itertools
+import traceback
+from collections import deque
+
+from gi.repository import GLib, GObject
+
+import utils
 
 # TODO
 GARMIN_NONE = 0
+GARMIN_AUTHENTICATION_FAILED = 3
 GARMIN_DISCONNECTED = 5
+GARMIN_FAILED = 6
+
+class Priority:
+    # someone is waiting to see the result
+    INTERACTIVE = 0
+    NORMAL = 1
+    # syncing and so on, which can wait
+    BACKGROUND = 2
+
+class Cancelled(Exception):
+    pass
+
+class Dispatcher(object):
+    # calls everything posted since last time from one idle, in order
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def post(self, cb, *args):
+        with self.lock:
+            self.pending.append((cb, args))
+            # already waiting for the main loop
+            if len(self.pending) > 1:
+                return
+        GLib.idle_add(self.dispatch)
+
+    def dispatch(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+
+        for cb, args in pending:
+            try:
+                cb(*args)
+            except Exception:
+                traceback.print_exc()
+
+        return False
+
+class Job(utils.Future):
+    # also the future for its result, though that's usually passed to cb
+
+    def __init__(self, f, cb, args, priority, cost, items):
+        utils.Future.__init__(self)
+
+        self.f = f
+        self.cb = cb
+        self.args = args
+        self.priority = priority
+        # roughly how many bytes the job will transfer, if known
+        self.cost = cost
+        # the files the job is working on, which can be cancelled one
+        # at a time
+        self.items = items
+
+        # when it was queued, started running and finished
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+
+        self.cancelled = False
+        self.skipped = set()
+
+    @property
+    def name(self):
+        return self.f.__name__
+
+    def cancel(self, item=None):
+        if item is None:
+            self.cancelled = True
+        else:
+            self.skipped.add(item)
+            if self.items and self.skipped.issuperset(self.items):
+                self.cancelled = True
+
+    def is_cancelled(self, item=None):
+        return self.cancelled or item in self.skipped
+
+    def check_cancelled(self, item=None):
+        # called from the job itself at a convenient point, like
+        # between bursts of a download
+        if self.is_cancelled(item):
+            raise Cancelled()
+
+    @property
+    def wait_time(self):
+        return (self.started or time.time()) - self.queued
+
+    @property
+    def service_time(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.time()) - self.started
+
+    def run(self, instance):
+        self.started = time.time()
+        try:
+            value = None if self.cancelled else self.f(instance, *self.args)
+        except Exception as e:
+            self.finished = time.time()
+            self.set_result(None, e)
+            raise
+
+        self.finished = time.time()
+        self.set_result(value)
+
+class JobQueue(object):
+    # most urgent first, then in the order they were added. jobs are
+    # timed to guess when each will be done.
+
+    # until we've seen some
+    DEFAULT_DURATION = 1.0 # s
+    DEFAULT_RATE = 8192.0 # B/s
+    SMOOTHING = 0.3
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+        self.counter = itertools.count()
+        self.current = None
+
+        # results, and anything else the jobs want to tell the ui
+        # thread, in the order they happen
+        self.results = Dispatcher()
+
+        # stats
+        self.durations = {}
+        self.rate = self.DEFAULT_RATE
+        self.completed = 0
+        self.wait_time = 0.0
+        self.service_time = 0.0
+        # when the last few interactive jobs were added
+        self.interactions = deque(maxlen=6)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.heap)
+
+    def push(self, job):
+        if job.priority == Priority.INTERACTIVE:
+            self.interactions.append(time.time())
+
+        with self.lock:
+            heapq.heappush(self.heap,
+                (job.priority, next(self.counter), job))
+
+    def pop(self, above=None):
+        # only jobs more urgent than above, if it's given
+        with self.lock:
+            if not self.heap:
+                return None
+            if above is not None and self.heap[0][0] >= above:
+                return None
+            return heapq.heappop(self.heap)[2]
+
+    def post(self, cb, *args):
+        self.results.post(cb, *args)
+
+    def finish(self, job, value=None):
+        if not job.done():
+            job.set_result(value)
+        self.post(job.cb, job.value)
+
+    def clear(self):
+        with self.lock:
+            self.heap = []
+
+    def abort(self):
+        # their callbacks get None
+        with self.lock:
+            heap, self.heap = self.heap, []
+
+        for _, _, job in heap:
+            self.finish(job)
+
+    def cancel(self, job, item=None):
+        # waiting jobs are dropped straight away, running ones stop at
+        # the next chance they get
+        job.cancel(item)
+        if not job.cancelled:
+            return
+
+        with self.lock:
+            for i, entry in enumerate(self.heap):
+                if entry[2] is job:
+                    self.heap[i] = self.heap[-1]
+                    self.heap.pop()
+                    heapq.heapify(self.heap)
+                    break
+            else:
+                return
+
+        self.finish(job)
+
+    def run(self, instance, job):
+        previous, self.current = self.current, job
+        try:
+            job.run(instance)
+        finally:
+            self.current = previous
+            self.finish(job)
+            self.record(job)
+
+    def record(self, job):
+        utils.debug('devicequeue: {} waited {:.2f}s, ran for {:.2f}s',
+            job.name, job.wait_time, job.service_time)
+
+        with self.lock:
+            self.completed += 1
+            self.wait_time += job.wait_time
+            self.service_time += job.service_time
+
+            # a cancelled or failed job says nothing about how fast
+            # things go
+            if job.cancelled or job.skipped or job.error:
+                return
+
+            elapsed = job.service_time
+            if job.cost:
+                self.rate = self.smooth(self.rate, job.cost / max(elapsed, 0.001))
+            else:
+                self.durations[job.name] = self.smooth(
+                    self.durations.get(job.name, elapsed), elapsed)
+
+    def interaction_gap(self):
+        # None until there have been enough to say
+        times = list(self.interactions)
+        gaps = sorted(b - a for a, b in zip(times, times[1:]))
+        if not gaps:
+            return None
+        return gaps[len(gaps) // 2]
+
+    def smooth(self, old, new):
+        return old + self.SMOOTHING * (new - old)
+
+    def estimate(self, job):
+        if job.cost:
+            return job.cost / self.rate
+        return self.durations.get(job.name, self.DEFAULT_DURATION)
+
+    def schedule(self):
+        # [(job, seconds until it's done)], the running one first
+        now = time.time()
+        eta = 0.0
+        result = []
+
+        with self.lock:
+            current = self.current
+            if current:
+                started = current.started or now
+                eta = max(0.0, self.estimate(current) - (now - started))
+                result.append((current, eta))
+
+            for _, _, job in sorted(self.heap):
+                eta += self.estimate(job)
+                result.append((job, eta))
+
+        return result
 
 class queueable(object):
-    def __init__(self, extra=None):
+    def __init__(self, extra=None, priority=Priority.NORMAL, cost=None,
+                 items=None):
         self.extra = extra
+        self.priority = priority
+        # cost(*args) -> bytes
+        self.cost = cost
+        # items(*args) -> list of things which can be cancelled
+        self.items = items
 
     def __call__(self, f):
         def wrapper(*args):
             instance, cb = args[:2]
-            instance.funcs.append((f, cb, args[2:]))
+            args = args[2:]
+            cost = self.cost(*args) if self.cost else None
+            items = self.items(*args) if self.items else None
+            job = Job(f, cb, args, self.priority, cost, items)
+            instance.funcs.push(job)
 
-            if instance.status == GARMIN_NONE:
+            if 'FUGA_DEBUG' in os.environ:
+                # the device thread could have finished it already
+                schedule = instance.funcs.schedule()
+                utils.debug('devicequeue: {} queued, {} jobs, all done in ~{:.0f}s',
+                    f.__name__, len(schedule),
+                    schedule[-1][1] if schedule else 0)
+
+            if instance.status in (GARMIN_NONE, GARMIN_DISCONNECTED):
                 instance.start()
+            elif instance.status in (GARMIN_AUTHENTICATION_FAILED,
+                                     GARMIN_FAILED):
+                # it's not going to get anywhere so fail straight away
+                instance.funcs.abort()
 
             if self.extra:
                 self.extra(instance)
+
+            # so it can be cancelled
+            return job
         return wrapper
 
 class GarminQueue(GObject.GObject):
-    def __init__(self, cls):
+    def __init__(self, cls, config=None):
         GObject.GObject.__init__(self)
         self.cls = cls
+        self.config = config
         self.garmin = None
 
     @GObject.Signal(arg_types=(object,))
@@ -51,18 +345,39 @@ class GarminQueue(GObject.GObject):
             return super(self).__getattr__(self, name)
 
         if not self.garmin:
-            self.emit('garmin-changed', self.cls())
+            garmin = self.cls()
+            if self.config:
+                garmin.configure(self.config)
+            self.emit('garmin-changed', garmin)
             self.garmin.connect('status-changed', self.status_changed_cb)
 
         def func(func_cb, *args):
-            getattr(self.garmin, name)(func_cb, *args)
+            return getattr(self.garmin, name)(func_cb, *args)
         return func
 
     def status_changed_cb(self, garmin, status):
-        if status == GARMIN_DISCONNECTED:
+        # a garmin which can reconnect by itself is kept for next time,
+        # unless it's given up altogether
+        if status == GARMIN_FAILED or \
+           (status == GARMIN_DISCONNECTED and not garmin.reusable):
             self.garmin.disconnect_by_func(self.status_changed_cb)
             self.emit('garmin-changed', None)
 
+    def saved_file_list(self):
+        # as last listed, without waiting for the device
+        return self.cls.saved_file_list()
+
+    def cancel(self, job, item=None):
+        if self.garmin:
+            self.garmin.funcs.cancel(job, item)
+        else:
+            job.cancel(item)
+
+    def schedule(self):
+        if not self.garmin:
+            return []
+        return self.garmin.funcs.schedule()
+
     def shutdown(self):
         if self.garmin:
             self.garmin.shutdown()
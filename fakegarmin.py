@@ -16,24 +16,28 @@
 
 import os
 import random
-from datetime import datetime
 
 from gi.repository import GLib, GObject
 
 import ant.fs.file
 
-from garmin import Garmin, FILETYPES, AntFile
-from devicequeue import queueable
+from garmin import Garmin, FILETYPES, AntFile, FileList
+from devicequeue import queueable, JobQueue, Priority
 import utils
 
 class FakeAntFile(object):
     def __init__(self, base_path, name):
         self.filename = name
 
-        date, time, subtype, number = name.split('_')
-        self.save_date = datetime.strptime(date + '_' + time, '%Y-%m-%d_%H-%M-%S')
+        self.save_date, sub_type, number = utils.parse_fit_filename(name)
 
-        self.path = os.path.join(base_path, FILETYPES[int(subtype)], self.filename)
+        self.path = os.path.join(base_path, FILETYPES[sub_type], self.filename)
+
+        # it's listed from the disk so it must be there
+        self.downloaded = True
+
+    def set_downloaded(self):
+        pass
 
 class FakeGarmin(GObject.GObject):
 
@@ -50,14 +54,25 @@ class FakeGarmin(GObject.GObject):
         self.authentication_fail = authentication_fail
         self.wait_time = int(os.environ.get('FAKE_GARMIN_TIME', 200))
 
-        self.funcs = []
+        self.funcs = JobQueue()
+
+        # start again with a new one each time
+        self.reusable = False
+
+    @classmethod
+    def saved_file_list(cls):
+        # listing is quick enough anyway
+        return None
+
+    def configure(self, config):
+        pass
 
     def change_status(self, status):
         self.status = status
-        # run in ui thread
-        GLib.idle_add(lambda: self.emit('status-changed', status))
+        # run in ui thread, in order with the results of jobs
+        self.funcs.post(self.emit, 'status-changed', status)
 
-    @utils.run_in_thread
+    @utils.run_in_pool('device')
     def start(self):
         self.change_status(Garmin.Status.CONNECTING)
 
@@ -80,29 +95,27 @@ class FakeGarmin(GObject.GObject):
         GLib.timeout_add(self.wait_time, self.worker_cb)
 
     def worker_cb(self):
-        while self.funcs:
-            f, cb, args = self.funcs.pop(0)
-            ret = f(self, *args)
-            # run in ui thread
-            GLib.idle_add(lambda: cb(ret))
+        job = self.funcs.pop()
+        while job:
+            self.funcs.run(self, job)
+            job = self.funcs.pop()
 
         self.loop.quit()
         self.change_status(Garmin.Status.DISCONNECTED)
 
-    @queueable()
+    @queueable(priority=Priority.INTERACTIVE)
     def get_file_list(self):
         base_path = os.environ.get('FAKE_GARMIN_BASE_PATH', None)
         if not base_path:
             base_path = os.path.join(GLib.get_user_data_dir(),
                 'fuga', '3868484997')
 
-        files = {}
-        for filetype in FILETYPES:
-            files[filetype] = []
+        files = FileList()
 
         if 'FAKE_GARMIN_NO_ACTIVITIES' not in os.environ:
             path = os.path.join(base_path, 'activities')
-            activities = os.listdir(path)
+            # skip sidecars
+            activities = [a for a in os.listdir(path) if a.endswith('.fit')]
 
             random.shuffle(activities)
 
@@ -112,13 +125,17 @@ class FakeGarmin(GObject.GObject):
 
         return files
 
-    @queueable()
+    @queueable(priority=Priority.INTERACTIVE)
     def download_file(self, antfile, progress_cb):
         raise NotImplementedError
 
-    @queueable()
+    @queueable(priority=Priority.BACKGROUND)
+    def download_files(self, antfiles, file_cb, progress_cb):
+        raise NotImplementedError
+
+    @queueable(priority=Priority.INTERACTIVE)
     def delete_file(self, antfile):
         raise NotImplementedError
 
     def shutdown(self):
-        self.funcs = []
+        self.funcs.clear()
@@ -14,12 +14,20 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import mmap
+import array
+
+import numpy
 import fitparse
 from fitparse.base import FitParseError
 
 from gi.repository import GObject
 
-from utils import run_in_thread
+from utils import run_in_pool, to_timestamp
+import sidecar
+import fitreader
+
+NAN = float('nan')
 
 class Fit(GObject.GObject):
 
@@ -33,55 +41,142 @@ class Fit(GObject.GObject):
     def status_changed(self, status):
         pass
 
+    @GObject.Signal
+    def summary_parsed(self):
+        pass
+
+    @GObject.Signal(arg_types=(object,))
+    def records_decoded(self, records):
+        # a list of record dicts, emitted while parsing
+        pass
+
+    # how many records to decode before handing them to the main loop
+    CHUNK_SIZE = 500
+
     def __init__(self, filename):
         GObject.GObject.__init__(self)
 
         self.filename = filename
 
         self.summary = None
+        self.columns = None
+        self.summary_requested = False
 
         self.status = Fit.Status.NONE
 
-    @run_in_thread
     def parse(self):
         if self.status != Fit.Status.NONE:
             return
         self.status = Fit.Status.PARSING
         self.emit('status-changed', self.status)
 
+        self.parse_thread()
+
+    @run_in_pool('parse')
+    def parse_thread(self):
         try:
-            self.fit = fitparse.FitFile(self.filename,
-                data_processor=fitparse.StandardUnitsDataProcessor())
+            cached = sidecar.load(self.filename)
+            if cached:
+                self.summary, self.columns = cached
+            else:
+                self.summary, self.columns = self.stream()
         except FitParseError:
             self.status = Fit.Status.FAILED
             GObject.idle_add(lambda: self.emit('status-changed', self.status))
             return
 
-        self.fit.parse()
+        self.status = Fit.Status.PARSED
+        GObject.idle_add(lambda: self.emit('status-changed', self.status))
+
+    @run_in_pool('parse')
+    def parse_summary(self):
+        if self.summary_requested:
+            return
+        self.summary_requested = True
+
+        try:
+            summary = load_summary(self.filename)
+        except (FitParseError, EnvironmentError):
+            summary = None
 
-        # find the summary message
-        for msg in self.fit.messages:
-            if msg.name == 'session':
-                self.summary = msg
-                break
+        def idle():
+            if self.summary is None:
+                self.summary = summary
+            self.emit('summary-parsed')
+        GObject.idle_add(idle)
+
+    def stream(self):
+        # decode with fitreader, passing the records to the main loop in
+        # chunks as we go so they can be shown before the whole file has
+        # been read. only the columns are kept afterwards.
+        try:
+            with open(self.filename, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            raise FitParseError('failed to open file')
+
+        def chunk_cb(chunk):
+            GObject.idle_add(self.emit, 'records-decoded', chunk)
 
+        try:
+            summary, columns = read_records(data, chunk_cb, self.CHUNK_SIZE)
+        except fitreader.FitReaderError:
+            # fitparse knows about much more of the format than we do
+            summary, columns = decode_file(self.filename)
+        finally:
+            data.close()
+
+        try:
+            sidecar.save(self.filename, summary, columns)
+        except EnvironmentError:
+            pass
+
+        return summary, columns
+
+    def parse_from(self, future):
+        # the file is already being parsed elsewhere, like straight from
+        # the buffer it was downloaded into, so wait for that instead
+        if self.status != Fit.Status.NONE:
+            return
+        self.status = Fit.Status.PARSING
+        self.emit('status-changed', self.status)
+
+        def done_cb(future):
+            try:
+                self.summary, self.columns = future.result()
+            except Exception:
+                # have another go from the file
+                self.parse_thread()
+                return
+
+            self.status = Fit.Status.PARSED
+            self.emit('status-changed', self.status)
+
+        future.add_done_callback(done_cb)
+
+    def load(self, summary, columns):
+        # take the results of a parse done elsewhere
+        if self.status != Fit.Status.NONE:
+            return
+
+        self.summary = summary
+        self.columns = columns
         self.status = Fit.Status.PARSED
-        GObject.idle_add(lambda: self.emit('status-changed', self.status))
+        self.emit('status-changed', self.status)
 
-    def records(self):
-        for m in self.fit.messages:
-            if m.name == 'record':
-                yield m
+    def track(self):
+        # deliberately break if not parsed yet
+        return Track(self.columns)
 
     def get(self, name, default=0):
         if not self.summary:
             return default
 
         val = self.summary.get(name)
-        if not val or val.value is None:
+        if val is None:
             return default
 
-        return val.value
+        return val
 
     def time_triplet(self, seconds):
         seconds = int(seconds)
@@ -110,3 +205,150 @@ class Fit(GObject.GObject):
 
     def get_start_time(self):
         return self.get('start_time')
+
+class Track(object):
+    # the columns as numpy arrays sharing their memory, with NaN where
+    # there's no sample. timestamps are seconds since the epoch.
+
+    def __init__(self, columns):
+        length = len(columns['timestamp']) if 'timestamp' in columns else 0
+
+        for name in sidecar.COLUMNS:
+            column = columns.get(name)
+            if column is None or len(column) != length:
+                values = numpy.empty(length)
+                values.fill(numpy.nan)
+            elif length == 0:
+                values = numpy.empty(0)
+            else:
+                values = numpy.frombuffer(column, dtype=numpy.float64)
+            setattr(self, name, values)
+
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def mask(self, name):
+        return ~numpy.isnan(getattr(self, name))
+
+    @property
+    def has_position(self):
+        return self.mask('position_lat') & self.mask('position_long')
+
+    def positions(self):
+        # only the records with a position
+        mask = self.has_position
+        return self.position_lat[mask], self.position_long[mask]
+
+def append_record(columns, values):
+    for name, column in columns.items():
+        val = values.get(name)
+        if val is None:
+            column.append(NAN)
+        elif name == 'timestamp':
+            column.append(to_timestamp(val))
+        else:
+            column.append(val)
+
+def read_records(data, chunk_cb=None, chunk_size=0):
+    # chunk_cb gets lists of record dicts as they're decoded
+    reader = fitreader.FitReader(data)
+
+    summary = None
+    columns = dict((name, array.array('d'))
+                   for name in sidecar.COLUMNS)
+    chunk = []
+
+    for num, values in reader.messages((fitreader.Message.RECORD,
+                                        fitreader.Message.SESSION)):
+        if num == fitreader.Message.SESSION:
+            if summary is None:
+                summary = values
+            continue
+
+        append_record(columns, values)
+
+        if chunk_cb:
+            chunk.append(values)
+            if len(chunk) >= chunk_size:
+                chunk_cb(chunk)
+                chunk = []
+
+    if chunk:
+        chunk_cb(chunk)
+
+    return summary, columns
+
+@run_in_pool('parse')
+def parse_buffer(filename, data):
+    # from what was just downloaded so it isn't read back in; saves the
+    # sidecar too
+    return decode_buffer(filename, data)
+
+def decode_buffer(filename, data):
+    try:
+        summary, columns = read_records(data)
+    except fitreader.FitReaderError:
+        summary, columns = decode_file(filename)
+
+    try:
+        sidecar.save(filename, summary, columns)
+    except EnvironmentError:
+        pass
+
+    return summary, columns
+
+def decode_file(filename):
+    # with fitparse
+    f = fitparse.FitFile(filename,
+        data_processor=fitparse.StandardUnitsDataProcessor())
+    f.parse()
+
+    summary = None
+    columns = dict((name, array.array('d'))
+                   for name in sidecar.COLUMNS)
+
+    for msg in f.messages:
+        if msg.name == 'record':
+            append_record(columns, msg.get_values())
+
+        # find the summary message
+        elif msg.name == 'session' and summary is None:
+            summary = msg.get_values()
+
+    return summary, columns
+
+def load_summary(filename):
+    # the sidecar's if it's up to date, else fitreader's, else
+    # fitparse's
+    summary = sidecar.load_summary(filename)
+    if summary is not None:
+        return summary
+
+    try:
+        result = fitreader.read_summary(filename)
+    except fitreader.FitReaderError:
+        result = None
+
+    if result:
+        return result['session']
+    return load_file(filename)[0]
+
+def load_file(filename):
+    # the sidecar's if it's up to date, else decode it and save one
+    cached = sidecar.load(filename)
+    if cached:
+        return cached
+
+    with open(filename, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty, so let fitparse say what's wrong with it
+            return decode_file(filename)
+
+    try:
+        return decode_buffer(filename, data)
+    finally:
+        data.close()
@@ -0,0 +1,296 @@
+# Copyright (C) 2015 Jonny Lamb <jonnylamb@jonnylamb.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# A very small FIT reader which only knows about the handful of fields
+# fuga actually shows. Messages we're not interested in are skipped
+# using the sizes from their definition messages without looking at
+# their contents, which is much quicker than having fitparse decode
+# the whole file when all we want is the session summary.
+#
+# Values are converted to the same units fitparse's
+# StandardUnitsDataProcessor gives us.
+
+import mmap
+import struct
+from datetime import datetime, timedelta
+
+class FitReaderError(Exception):
+    pass
+
+# FIT timestamps are seconds since 1989-12-31 00:00 UTC
+FIT_EPOCH = datetime(1989, 12, 31)
+
+class Message:
+    SESSION = 18
+    LAP = 19
+    RECORD = 20
+    ACTIVITY = 34
+
+SPORTS = {
+    0: 'generic',
+    1: 'running',
+    2: 'cycling',
+    3: 'transition',
+    4: 'fitness_equipment',
+    5: 'swimming',
+    6: 'basketball',
+    7: 'soccer',
+    8: 'tennis',
+    9: 'american_football',
+    10: 'training',
+    11: 'walking',
+    12: 'cross_country_skiing',
+    13: 'alpine_skiing',
+    14: 'snowboarding',
+    15: 'rowing',
+    16: 'mountaineering',
+    17: 'hiking',
+    18: 'multisport',
+    19: 'paddling',
+}
+
+def date_time(value):
+    return FIT_EPOCH + timedelta(seconds=value)
+
+def scale(factor, offset=0):
+    return lambda value: float(value) / factor - offset
+
+def semicircles(value):
+    return value * 180.0 / 2 ** 31
+
+def speed(value):
+    # mm/s to km/h
+    return value * 3.6 / 1000
+
+# base type number -> (struct format, invalid value)
+BASE_TYPES = {
+    0x00: ('B', 0xFF),        # enum
+    0x01: ('b', 0x7F),        # sint8
+    0x02: ('B', 0xFF),        # uint8
+    0x83: ('h', 0x7FFF),      # sint16
+    0x84: ('H', 0xFFFF),      # uint16
+    0x85: ('i', 0x7FFFFFFF),  # sint32
+    0x86: ('I', 0xFFFFFFFF),  # uint32
+    0x0A: ('B', 0x00),        # uint8z
+    0x8B: ('H', 0x0000),      # uint16z
+    0x8C: ('I', 0x00000000),  # uint32z
+}
+
+# global message number -> field number -> (name, convert)
+FIELDS = {
+    Message.SESSION: {
+        253: ('timestamp', date_time),
+        2: ('start_time', date_time),
+        5: ('sport', lambda value: SPORTS.get(value, value)),
+        7: ('total_elapsed_time', scale(1000)),
+        8: ('total_timer_time', scale(1000)),
+        9: ('total_distance', scale(100)),
+        11: ('total_calories', None),
+        16: ('avg_heart_rate', None),
+        17: ('max_heart_rate', None),
+        22: ('total_ascent', None),
+        23: ('total_descent', None),
+        26: ('num_laps', None),
+    },
+    Message.RECORD: {
+        253: ('timestamp', date_time),
+        0: ('position_lat', semicircles),
+        1: ('position_long', semicircles),
+        2: ('altitude', scale(5, 500)),
+        3: ('heart_rate', None),
+        4: ('cadence', None),
+        # cm to km
+        5: ('distance', scale(100000)),
+        6: ('speed', speed),
+        7: ('power', None),
+        # the enhanced fields just have more range so use them in
+        # place of the normal ones
+        73: ('speed', speed),
+        78: ('altitude', scale(5, 500)),
+    },
+    Message.ACTIVITY: {
+        253: ('timestamp', date_time),
+        0: ('total_timer_time', scale(1000)),
+        1: ('num_sessions', None),
+        5: ('local_timestamp', date_time),
+    },
+}
+
+class Definition(object):
+    def __init__(self, global_num, endian, fields, size):
+        self.global_num = global_num
+        self.size = size
+        self.timestamp = None
+
+        # only keep what we know how to decode:
+        # (offset, struct, invalid, name, convert)
+        self.fields = []
+
+        wanted = FIELDS.get(global_num, {})
+        offset = 0
+        for num, field_size, base_type in fields:
+            if num in wanted and base_type in BASE_TYPES:
+                fmt, invalid = BASE_TYPES[base_type]
+                s = struct.Struct(endian + fmt)
+                # arrays aren't interesting
+                if s.size == field_size:
+                    name, convert = wanted[num]
+                    self.fields.append((offset, s, invalid, name, convert))
+                    if num == 253:
+                        self.timestamp = (offset, s)
+            offset += field_size
+
+    def decode(self, data, pos):
+        values = {}
+        for offset, s, invalid, name, convert in self.fields:
+            value = s.unpack_from(data, pos + offset)[0]
+            if value == invalid:
+                continue
+            values[name] = convert(value) if convert else value
+        return values
+
+    def raw_timestamp(self, data, pos):
+        offset, s = self.timestamp
+        return s.unpack_from(data, pos + offset)[0]
+
+class FitReader(object):
+    def __init__(self, data):
+        # data can be anything struct can unpack from: a string, an
+        # mmap or a buffer.
+        self.data = data
+
+        if len(data) < 12:
+            raise FitReaderError('file too short')
+
+        header_size, _, _, data_size, magic = \
+            struct.unpack_from('<BBHI4s', data)
+
+        if magic != '.FIT' or header_size < 12:
+            raise FitReaderError('not a FIT file')
+
+        self.start = header_size
+        self.end = min(header_size + data_size, len(data))
+
+    def messages(self, wanted):
+        """Yield (global message number, values) for every data message
+        whose global number is in wanted."""
+
+        data = self.data
+        definitions = {}
+        pos = self.start
+
+        # compressed timestamps are relative to the last full one. we only
+        # look at the timestamps of messages we're decoding anyway, which
+        # is fine for records as they all have one.
+        last_timestamp = None
+
+        try:
+            while pos < self.end:
+                header = ord(data[pos])
+                pos += 1
+
+                if header & 0x80:
+                    # compressed timestamp header
+                    local = (header >> 5) & 0x3
+                    time_offset = header & 0x1F
+                    compressed = True
+                    definition = False
+                    developer = False
+                else:
+                    local = header & 0xF
+                    compressed = False
+                    definition = header & 0x40
+                    developer = header & 0x20
+
+                if definition:
+                    arch, global_num, num_fields = \
+                        struct.unpack_from('<xBHB', data, pos)
+                    endian = '>' if arch else '<'
+                    if arch:
+                        global_num = ((global_num & 0xFF) << 8) | (global_num >> 8)
+                    pos += 5
+
+                    fields = []
+                    size = 0
+                    for i in range(num_fields):
+                        fields.append(struct.unpack_from('BBB', data, pos))
+                        size += fields[-1][1]
+                        pos += 3
+
+                    if developer:
+                        num_dev_fields = ord(data[pos])
+                        pos += 1
+                        for i in range(num_dev_fields):
+                            size += ord(data[pos + 1])
+                            pos += 3
+
+                    definitions[local] = Definition(global_num, endian,
+                                                    fields, size)
+                    continue
+
+                try:
+                    d = definitions[local]
+                except KeyError:
+                    raise FitReaderError('data message without a definition')
+
+                if d.global_num in wanted:
+                    values = d.decode(data, pos)
+
+                    if compressed:
+                        if last_timestamp is not None:
+                            last_timestamp += (time_offset - last_timestamp) & 0x1F
+                            values['timestamp'] = date_time(last_timestamp)
+                    elif d.timestamp:
+                        last_timestamp = d.raw_timestamp(data, pos)
+
+                    yield d.global_num, values
+
+                pos += d.size
+        except (struct.error, IndexError):
+            raise FitReaderError('truncated file')
+
+def read_summary(path):
+    """Return a dict with the first session message, a list of the
+    activity messages and the number of laps, without decoding any of
+    the record messages."""
+
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        reader = FitReader(data)
+
+        session = None
+        activities = []
+        num_laps = 0
+
+        for num, values in reader.messages((Message.SESSION,
+                                            Message.LAP,
+                                            Message.ACTIVITY)):
+            if num == Message.SESSION and session is None:
+                session = values
+            elif num == Message.LAP:
+                num_laps += 1
+            elif num == Message.ACTIVITY:
+                activities.append(values)
+
+        return {
+            'session': session,
+            'activities': activities,
+            'num_laps': num_laps,
+        }
+    finally:
+        data.close()
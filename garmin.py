@@ -20,17 +20,25 @@
 
 import os
 import sys
+import json
 import array
 import time
+import random
+import threading
+import traceback
+import Queue
 from datetime import datetime
 
 from gi.repository import GLib, GObject
 
 import ant.fs.manager
 import ant.fs.file
-from ant.fs.command import EraseRequestCommand, EraseResponse
+from ant.fs.beacon import Beacon
+from ant.fs.command import EraseRequestCommand, EraseResponse, \
+    DownloadRequest, DownloadResponse
 
-from devicequeue import queueable
+from devicequeue import queueable, JobQueue, Priority, Cancelled
+import fit
 import utils
 
 DIRECTORIES = {
@@ -59,12 +67,62 @@ class Device(object):
     PROFILE_VERSION_FILE = 'version'
     PASSKEY_FILE = 'authfile'
     NAME_FILE = 'name'
+    SNAPSHOT_FILE = 'snapshot.json'
+
+    # one per device so the saved listing and the connected device
+    # share a snapshot: (basedir, serial) -> Device
+    devices = {}
+    devices_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, basedir, serial, name):
+        with cls.devices_lock:
+            key = (basedir, serial)
+            if key not in cls.devices:
+                cls.devices[key] = cls(basedir, serial, name)
+            return cls.devices[key]
+
+    @classmethod
+    def last_listed(cls, basedir):
+        # None if nothing's been listed yet
+        newest = None
+        try:
+            serials = os.listdir(basedir)
+        except OSError:
+            return None
+
+        for serial in serials:
+            if not serial.isdigit():
+                continue
+
+            path = os.path.join(basedir, serial)
+            try:
+                mtime = os.path.getmtime(os.path.join(path, cls.SNAPSHOT_FILE))
+                with open(os.path.join(path, cls.NAME_FILE)) as f:
+                    name = f.read()
+            except (OSError, IOError):
+                continue
+
+            if newest is None or mtime > newest[0]:
+                newest = (mtime, int(serial), name)
+
+        if newest is None:
+            return None
+
+        try:
+            return cls.get(basedir, newest[1], newest[2])
+        except Device.ProfileVersionMismatch:
+            return None
 
     def __init__(self, basedir, serial, name):
         self.path = os.path.join(basedir, str(serial))
         self.serial = serial
         self.name = name
 
+        # the directory as it was last listed: str(index) -> entry
+        self.snapshot_lock = threading.RLock()
+        self._snapshot = None
+
         # check profile version, if not a new device
         if os.path.isdir(self.path):
             if self.version < self.PROFILE_VERSION:
@@ -90,13 +148,6 @@ class Device(object):
             with open(path, 'w') as f:
                 f.write(self.name)
 
-# TODO
-#    @staticmethod
-#    def from_saved(basedir, serial):
-#        path = os.path.join(basedir, str(serial), self.NAME_FILE)
-#
-#        return Device(basedir, serial, name)
-
     @property
     def version(self):
         if not hasattr(self, '_version'):
@@ -141,12 +192,47 @@ class Device(object):
         except:
             pass
 
+    @property
+    def snapshot(self):
+        if self._snapshot is None:
+            path = os.path.join(self.path, self.SNAPSHOT_FILE)
+            try:
+                with open(path, 'rb') as f:
+                    self._snapshot = json.load(f)
+            except (IOError, ValueError):
+                self._snapshot = {}
+
+        return self._snapshot
+
+    def write_snapshot(self):
+        path = os.path.join(self.path, self.SNAPSHOT_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            json.dump(self._snapshot, f)
+        os.rename(tmp_path, path)
+
+    def save_snapshot(self, snapshot):
+        # the device thread lists, the ui thread marks downloads
+        with self.snapshot_lock:
+            self._snapshot = snapshot
+            self.write_snapshot()
+
+    def set_downloaded(self, index):
+        with self.snapshot_lock:
+            entry = self.snapshot.get(str(index))
+            if entry and not entry['downloaded']:
+                entry['downloaded'] = True
+                self.write_snapshot()
+
 class AntFile(object):
     def __init__(self, device, antfile):
+        self.device = device
         self.antfile = antfile
+        # whether there's a copy on the computer; filled in by
+        # get_file_list from the snapshot
+        self.downloaded = False
 
-        self.filename = '{0}_{1}_{2}.fit'.format(
-            self.save_date.strftime("%Y-%m-%d_%H-%M-%S"),
+        self.filename = utils.fit_filename(self.save_date,
             self.antfile.get_fit_sub_type(),
             self.antfile.get_fit_file_number())
 
@@ -167,6 +253,289 @@ class AntFile(object):
     def index(self):
         return self.antfile.get_index()
 
+    @property
+    def size(self):
+        return self.antfile.get_size()
+
+    def snapshot_entry(self):
+        return {
+            'date': utils.to_timestamp(self.save_date),
+            'size': self.size,
+            'filename': self.filename,
+            'downloaded': self.downloaded,
+        }
+
+    def set_downloaded(self):
+        self.downloaded = True
+        self.device.set_downloaded(self.index)
+
+class SavedAntFile(AntFile):
+    # from the snapshot, for showing before the device has been listed
+    # again
+
+    def __init__(self, device, index, entry):
+        self.device = device
+        self._index = index
+        self._size = entry['size']
+        self.filename = entry['filename']
+        self._save_date = utils.from_timestamp(entry['date'])
+
+        self.sub_type = utils.parse_fit_filename(self.filename)[1]
+        self.path = os.path.join(device.path, FILETYPES[self.sub_type], self.filename)
+
+        # downloads are marked in the snapshot as they finish and
+        # deleted files are noticed when they're opened
+        self.downloaded = entry['downloaded']
+
+    @property
+    def save_date(self):
+        return self._save_date
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def size(self):
+        return self._size
+
+def discard_partial(path):
+    for partial in (path + '.part', path + '.part.json'):
+        try:
+            os.unlink(partial)
+        except OSError:
+            pass
+
+class DownloadSink(object):
+    # where the bursts of a download go, starting from offset and crc
+
+    offset = 0
+    crc = 0
+
+    def write(self, offset, data, crc):
+        raise NotImplementedError
+
+    def finish(self):
+        # returns (path, size)
+        raise NotImplementedError
+
+    def close(self):
+        # after finish() or when giving up
+        pass
+
+    def discard(self):
+        # after close() if it isn't wanted any more
+        pass
+
+class FileSink(DownloadSink):
+    # writes into <path>.part, keeping the offset and crc reached in
+    # <path>.part.json so a dropped download can carry on. with keep
+    # it's kept in memory too so it can be parsed without reading it
+    # back in.
+
+    def __init__(self, antfile, keep=False):
+        self.path = antfile.path
+        self.part_path = self.path + '.part'
+        self.state_path = self.part_path + '.json'
+
+        # to tell if the file on the device has changed since
+        self.stamp = [antfile.size, utils.to_timestamp(antfile.save_date)]
+
+        self.offset, self.crc = self.load_state()
+
+        self.buffer = bytearray(antfile.size) if keep else None
+        self.data = None
+
+        if self.offset:
+            self.f = open(self.part_path, 'r+b')
+            # anything past the offset wasn't recorded so can't be trusted
+            self.f.truncate(self.offset)
+            if self.buffer is not None:
+                self.f.readinto(memoryview(self.buffer)[:self.offset])
+        else:
+            self.f = open(self.part_path, 'wb')
+
+    def load_state(self):
+        try:
+            with open(self.state_path, 'rb') as f:
+                state = json.load(f)
+            if state['stamp'] == self.stamp and \
+               os.path.getsize(self.part_path) >= state['offset']:
+                return state['offset'], state['crc']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        return 0, 0
+
+    def write(self, offset, data, crc):
+        self.f.seek(offset)
+        data.tofile(self.f)
+        self.f.flush()
+
+        end = offset + len(data)
+        if self.buffer is not None:
+            if end > len(self.buffer):
+                self.buffer.extend(bytearray(end - len(self.buffer)))
+            self.buffer[offset:end] = data
+
+        self.offset = end
+        self.crc = crc
+
+        with open(self.state_path, 'wb') as f:
+            json.dump({'stamp': self.stamp,
+                       'offset': self.offset,
+                       'crc': self.crc}, f)
+
+    def finish(self):
+        size = self.f.tell()
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+
+        os.rename(self.part_path, self.path)
+        os.unlink(self.state_path)
+
+        # and make sure the rename sticks
+        fd = os.open(os.path.dirname(self.path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        if self.buffer is not None:
+            self.data = memoryview(self.buffer)[:size]
+        return self.path, size
+
+    def close(self):
+        # leave what we've got for next time
+        if not self.f.closed:
+            self.f.close()
+
+    def discard(self):
+        discard_partial(self.path)
+
+class ProgressThrottle(object):
+    # passes progress on from the device thread at most RATE times a
+    # second, with the rate and seconds left (-1 if not known yet).
+    # finishing always gets through.
+
+    RATE = 10 # updates/s
+
+    def __init__(self, size, post, cb):
+        self.size = size
+        self.post = post
+        self.cb = cb
+
+        # measured from the first update so a resumed download
+        # doesn't look quicker than it is
+        self.start = None
+        self.start_fraction = 0.0
+        self.last = 0.0
+
+        # stats
+        self.posted = 0
+        self.dropped = 0
+
+    def update(self, fraction, *args):
+        # cb(*args, fraction, rate, seconds left)
+        now = time.time()
+        if self.start is None:
+            self.start = now
+            self.start_fraction = fraction
+
+        if fraction < 1.0 and now - self.last < 1.0 / self.RATE:
+            self.dropped += 1
+            return
+        self.last = now
+
+        elapsed = now - self.start
+        rate = (fraction - self.start_fraction) * self.size / elapsed \
+            if elapsed else 0.0
+        eta = (1.0 - fraction) * self.size / rate if rate > 0 else -1.0
+
+        self.posted += 1
+        self.post(self.cb, *(args + (fraction, rate, eta)))
+
+class FileList(dict):
+    # files by sub type; new and changed are AntFiles, removed are
+    # filenames
+
+    def __init__(self):
+        dict.__init__(self, ((filetype, []) for filetype in FILETYPES))
+        self.new = []
+        self.changed = []
+        self.removed = []
+
+def diff_directory(device, antfiles):
+    # only new or changed files are looked for on disk
+    # the main loop marks downloads in the snapshot as they finish so
+    # hold on to it until the new one is saved
+    with device.snapshot_lock:
+        old = device.snapshot
+        snapshot = {}
+        files = FileList()
+
+        for antfile in antfiles:
+            key = str(antfile.index)
+            entry = old.get(key)
+            new_entry = antfile.snapshot_entry()
+
+            if entry is None:
+                files.new.append(antfile)
+                antfile.downloaded = os.path.exists(antfile.path)
+            elif (entry['date'], entry['size'], entry['filename']) != \
+                 (new_entry['date'], new_entry['size'], new_entry['filename']):
+                files.changed.append(antfile)
+                antfile.downloaded = os.path.exists(antfile.path)
+                if entry['filename'] != new_entry['filename']:
+                    files.removed.append(entry['filename'])
+            else:
+                antfile.downloaded = entry['downloaded']
+
+            new_entry['downloaded'] = antfile.downloaded
+            snapshot[key] = new_entry
+
+            files[antfile.antfile.get_fit_sub_type()].append(antfile)
+
+        files.removed.extend(old_entry['filename']
+                             for old_key, old_entry in old.items()
+                             if old_key not in snapshot)
+
+        device.save_snapshot(snapshot)
+
+    # there's nothing left to resume any partial downloads of these from
+    for filename in files.removed:
+        try:
+            sub_type = utils.parse_fit_filename(filename)[1]
+            discard_partial(os.path.join(device.path, FILETYPES[sub_type], filename))
+        except (ValueError, IndexError, KeyError):
+            pass
+
+    return files
+
+def snapshot_file_list(device):
+    # None if the device has never been listed
+    with device.snapshot_lock:
+        snapshot = dict(device.snapshot)
+
+    if not snapshot:
+        return None
+
+    files = FileList()
+    for key, entry in snapshot.items():
+        try:
+            antfile = SavedAntFile(device, int(key), entry)
+        except (ValueError, IndexError, KeyError):
+            continue
+        files[antfile.sub_type].append(antfile)
+
+    return files
+
+class DeviceTimeout(Exception):
+    def __init__(self, phase):
+        Exception.__init__(self, 'timed out in {} phase'.format(phase))
+        self.phase = phase
+
 class Garmin(ant.fs.manager.Application,
              GObject.GObject):
 
@@ -179,6 +548,24 @@ class Garmin(ant.fs.manager.Application,
         AUTHENTICATION_FAILED = 3
         CONNECTED = 4
         DISCONNECTED = 5
+        # gave up trying to connect; a new Garmin has to be made
+        FAILED = 6
+
+    # how long each part of connecting can take, in seconds. transport
+    # is how long to wait for the device to say anything once
+    # connected, so a long download doesn't run out of time.
+    DEADLINES = {
+        'search': 30,
+        'link': 10,
+        'auth': 60,
+        'transport': 20,
+    }
+
+    # how many times to try connecting again before giving up, and how
+    # long to wait in between
+    RETRIES = 3
+    BACKOFF_BASE = 1 # s
+    BACKOFF_CAP = 16 # s
 
     @GObject.Signal(arg_types=(int,))
     def status_changed(self, status):
@@ -193,15 +580,61 @@ class Garmin(ant.fs.manager.Application,
 
         self.status = Garmin.Status.NONE
         self.device = None
-        self.funcs = []
+        self.funcs = JobQueue()
 
         self.loop = None
         self.timeout_source = None
 
+        # the ant node is kept open between sessions so connecting again
+        # doesn't have to start from scratch. if something goes wrong
+        # with it we give up and let a new Garmin be made.
+        self.reusable = True
+        self.sessions = 0
+        self.in_session = False
+        self.closing = False
+        self.transported = False
+        # set to cut short waiting before trying again
+        self.wakeup = threading.Event()
+
+        self.deadlines = dict(self.DEADLINES)
+        self.retries = self.RETRIES
+
+        # what part of the session we're in and when it has to be done
+        # by, and how long each finished part took
+        self.phase = None
+        self.phase_start = None
+        self.deadline = None
+        self.phase_times = []
+
+        # stats: name -> list of seconds
+        self.session_start = None
+        self.first_byte = False
+        self.latencies = {'connect': [], 'auth': [], 'first_byte': []}
+
+    @classmethod
+    def saved_file_list(cls):
+        # what was on the device we last listed, without connecting
+        device = Device.last_listed(
+            os.path.join(GLib.get_user_data_dir(), cls.PRODUCT_NAME))
+        return snapshot_file_list(device) if device else None
+
+    def configure(self, config):
+        # [device] search_timeout = 30, retries = 3 and so on
+        if not config.has_section('device'):
+            return
+
+        for phase in self.deadlines:
+            option = phase + '_timeout'
+            if config.has_option('device', option):
+                self.deadlines[phase] = config.getfloat('device', option)
+
+        if config.has_option('device', 'retries'):
+            self.retries = config.getint('device', 'retries')
+
     def change_status(self, status):
         self.status = status
-        # run in ui thread
-        GLib.idle_add(lambda: self.emit('status-changed', status))
+        # run in ui thread, in order with the results of jobs
+        self.funcs.post(self.emit, 'status-changed', status)
 
     def setup_channel(self, channel):
         channel.set_period(4096)
@@ -211,14 +644,71 @@ class Garmin(ant.fs.manager.Application,
         channel.set_id(0, 0x01, 0)
         channel.open()
 
+    def record_latency(self, name, seconds):
+        self.latencies[name].append(seconds)
+        utils.debug('garmin: {} took {:.2f}s (session {})',
+            name, seconds, self.sessions)
+
+    def enter_phase(self, phase):
+        now = time.time()
+        if self.phase:
+            self.phase_times.append((self.phase, now - self.phase_start))
+
+        self.phase = phase
+        self.phase_start = now
+        self.extend_deadline()
+
+    def extend_deadline(self):
+        timeout = self.deadlines.get(self.phase)
+        self.deadline = time.time() + timeout if timeout else None
+
+    def remaining(self, timeout=None):
+        # how long to wait for the next thing from the device: at most
+        # timeout, and no later than the deadline
+        if self.deadline is None:
+            return timeout
+
+        left = self.deadline - time.time()
+        if left <= 0:
+            raise DeviceTimeout(self.phase)
+
+        return left if timeout is None else min(timeout, left)
+
+    def log_phases(self):
+        self.enter_phase(None)
+        utils.debug('garmin: session {}: {}', self.sessions,
+            ', '.join('{} {:.2f}s'.format(phase, seconds)
+                      for phase, seconds in self.phase_times))
+        self.phase_times = []
+
+    def backoff(self, attempt):
+        # capped exponential, with jitter so we don't go in lockstep
+        # with the device's own beacon timing
+        delay = min(self.BACKOFF_CAP, self.BACKOFF_BASE * 2 ** (attempt - 1))
+        return random.uniform(delay / 2.0, delay)
+
+    def _get_beacon(self):
+        try:
+            return self._beacons.get(True, self.remaining())
+        except Queue.Empty:
+            raise DeviceTimeout(self.phase)
+
     def on_link(self, beacon):
+        self.record_latency('connect', time.time() - self.session_start)
         self.link()
         return True
 
     def on_authentication(self, beacon):
+        start = time.time()
+        try:
+            return self.authenticate()
+        finally:
+            self.record_latency('auth', time.time() - start)
+
+    def authenticate(self):
         self.change_status(Garmin.Status.AUTHENTICATION)
         serial, name = self.authentication_serial()
-        device = Device(self.path, serial, name)
+        device = Device.get(self.path, serial, name)
 
         passkey = device.passkey
 
@@ -230,12 +720,15 @@ class Garmin(ant.fs.manager.Application,
 
             self.device = device
             return True
+        except DeviceTimeout:
+            raise
         except:
             # print out this traceback with more logging
             self.change_status(Garmin.Status.AUTHENTICATION_FAILED)
             return False
 
     def on_transport(self, beacon):
+        self.transported = True
         self.change_status(Garmin.Status.CONNECTED)
 
         while True:
@@ -243,11 +736,11 @@ class Garmin(ant.fs.manager.Application,
                 self.timeout_source = None
                 return
 
-            while self.funcs:
-                f, cb, args = self.funcs.pop(0)
-                ret = f(self, *args)
-                # run in ui thread
-                GLib.idle_add(lambda: cb(ret))
+            self.run_jobs()
+
+            # a job lost the link
+            if self.closing or self.status != Garmin.Status.CONNECTED:
+                return
 
             # we've run out of things to do for now. set a timer so we don't
             # disconnect immediately.
@@ -259,11 +752,128 @@ class Garmin(ant.fs.manager.Application,
             def timeout_cb(data=None):
                 self.loop.quit()
                 self.loop = None
-            self.timeout_source = GLib.timeout_source_new_seconds(5)
+            timeout = self.idle_timeout()
+            utils.debug('garmin: idle, disconnecting in {:.0f}s', timeout)
+            self.timeout_source = GLib.timeout_source_new(int(timeout * 1000))
             self.timeout_source.set_callback(timeout_cb)
             self.timeout_source.attach(context)
             self.loop.run()
 
+    # how long to stay connected with nothing to do
+    IDLE_TIMEOUT = 5 # s
+    MAX_IDLE_TIMEOUT = 60 # s
+
+    def idle_timeout(self):
+        # if someone's been clicking around every so often stay connected
+        # long enough for their next click, but not if they're so slow
+        # about it we'd be connected for ages for nothing
+        gap = self.funcs.interaction_gap()
+        if gap is None:
+            return self.IDLE_TIMEOUT
+
+        timeout = gap * 1.5
+        if timeout > self.MAX_IDLE_TIMEOUT:
+            return self.IDLE_TIMEOUT
+
+        return max(self.IDLE_TIMEOUT, timeout)
+
+    def _get_command(self, timeout=15.0):
+        try:
+            response = ant.fs.manager.Application._get_command(self,
+                self.remaining(timeout))
+        except Queue.Empty:
+            # give up now rather than on the next go
+            self.remaining()
+            raise
+
+        if self.phase == 'transport':
+            self.extend_deadline()
+
+        if not self.first_byte:
+            self.first_byte = True
+            self.record_latency('first_byte', time.time() - self.session_start)
+        return response
+
+    def download_to(self, antfile, sink, progress_cb):
+        # like ant.fs.manager.Application.download but hands each burst
+        # to sink as it comes rather than keeping it all in memory, and
+        # can start part of the way through
+        if sink.offset:
+            utils.debug('garmin: resuming {} from {} of {} bytes',
+                antfile.filename, sink.offset, antfile.size)
+
+        try:
+            while True:
+                self._send_command(DownloadRequest(antfile.index,
+                    sink.offset, sink.offset == 0, sink.crc))
+
+                try:
+                    response = self._get_command()
+                except Queue.Empty:
+                    # try again from where we got to
+                    continue
+
+                if response._get_argument('response') != DownloadResponse.Response.OK:
+                    raise ant.fs.manager.AntFSDownloadException(
+                        'Could not download file', response._get_argument('response'))
+
+                remaining = response._get_argument('remaining')
+                offset = response._get_argument('offset')
+                size = response._get_argument('size')
+
+                sink.write(offset, response._get_argument('data')[:remaining],
+                           response._get_argument('crc'))
+
+                # a cancel during the last burst is too late to lose it
+                if sink.offset >= size:
+                    result = sink.finish()
+                    try:
+                        progress_cb(1.0)
+                    except Cancelled:
+                        pass
+                    return result
+
+                progress_cb(float(sink.offset) / size)
+        finally:
+            sink.close()
+
+    def is_listed(self, antfile):
+        # files from the saved listing can be asked for before the
+        # device has been listed again, by which time the index could
+        # be something else, or it could be another device altogether
+        entry = self.device.snapshot.get(str(antfile.index))
+        return antfile.device is self.device and entry is not None and \
+            entry['filename'] == antfile.filename
+
+    def download_and_parse(self, antfile, progress_cb, keep=False):
+        # returns (path, size, parsed). if keep is set parsed is a
+        # Future for the file's summary and columns: parsing starts
+        # straight away from what's still in memory and carries on while
+        # we get on with the next job. otherwise it's None and nothing
+        # is kept in memory.
+        sink = FileSink(antfile, keep)
+        try:
+            path, size = self.download_to(antfile, sink, progress_cb)
+        except Cancelled:
+            # nobody wants it any more so don't keep it for next time
+            sink.discard()
+            raise
+        parsed = fit.parse_buffer(path, sink.data) if keep else None
+        return path, size, parsed
+
+    def run_jobs(self, above=None):
+        # above is the priority of the job calling this, if any, so only
+        # jobs more urgent than it get to go first
+        while self.status == Garmin.Status.CONNECTED:
+            job = self.funcs.pop(above)
+            if not job:
+                break
+
+            # the device has only been quiet because it had nothing
+            # to do
+            self.extend_deadline()
+            self.funcs.run(self, job)
+
     def cancel_timer(self, remove_source=False):
         if self.timeout_source:
             self.timeout_source.destroy()
@@ -272,36 +882,119 @@ class Garmin(ant.fs.manager.Application,
             self.loop.quit()
             self.loop = None
 
-    @queueable(lambda self: self.cancel_timer(True))
+    @queueable(lambda self: self.cancel_timer(True), Priority.INTERACTIVE)
     def get_file_list(self):
         directory = self.download_directory()
 
         # get a list of remote files
-        files = {}
-        for filetype in FILETYPES:
-            files[filetype] = []
-
-        for antfile in directory.get_files():
-            subtype = antfile.get_fit_sub_type()
+        antfiles = [AntFile(self.device, antfile)
+                    for antfile in directory.get_files()
+                    if antfile.get_fit_sub_type() in FILETYPES]
 
-            if subtype in files:
-                files[subtype].append(AntFile(self.device, antfile))
+        start = time.time()
+        files = diff_directory(self.device, antfiles)
+        utils.debug('garmin: {} files, {} new, {} changed, {} removed in {:.1f}ms',
+            len(antfiles), len(files.new), len(files.changed),
+            len(files.removed), (time.time() - start) * 1000)
 
         return files
 
-    @queueable(lambda self: self.cancel_timer(True))
+    @queueable(lambda self: self.cancel_timer(True), Priority.INTERACTIVE,
+               lambda antfile, progress_cb: antfile.size,
+               lambda antfile, progress_cb: [antfile])
     def download_file(self, antfile, progress_cb):
+        job = self.funcs.current
+
+        if not self.is_listed(antfile):
+            discard_partial(antfile.path)
+            return None
+
+        # progress_cb(fraction, bytes_per_second, seconds_left)
+        throttle = ProgressThrottle(antfile.size, self.funcs.post, progress_cb)
+
         def cb(new_progress):
-            GLib.idle_add(lambda: progress_cb(new_progress))
+            # openant calls this after each burst so it's a good time to
+            # give up, leaving the link ready for the next job
+            job.check_cancelled(antfile)
+            throttle.update(new_progress)
 
         try:
-            return self.download(antfile.index, cb)
+            # only asked for one at a time from its details, so it's
+            # about to be looked at
+            return self.download_and_parse(antfile, cb, keep=True)
+        except Cancelled:
+            return None
         except:
             # print out this traceback with more logging
             self.change_status(Garmin.Status.DISCONNECTED)
             return None
 
-    @queueable(lambda self: self.cancel_timer(True))
+    @queueable(lambda self: self.cancel_timer(True), Priority.BACKGROUND,
+               lambda antfiles, file_cb, progress_cb:
+                   sum(antfile.size for antfile in antfiles),
+               lambda antfiles, file_cb, progress_cb: antfiles)
+    def download_files(self, antfiles, file_cb, progress_cb):
+        # all in one go so the link isn't dropped between files.
+        # file_cb(antfile, (path, size, None)) is called as each one
+        # finishes (None if it couldn't be downloaded) and progress_cb(antfile,
+        # fraction, total_fraction, bytes_per_second, seconds_left) as
+        # they go.
+        job = self.funcs.current
+        total = sum(antfile.size for antfile in antfiles) or 1
+        done = [0]
+        start = time.time()
+        throttle = ProgressThrottle(total, self.funcs.post, progress_cb)
+
+        def progress(antfile, fraction):
+            job.check_cancelled(antfile)
+
+            transferred = done[0] + fraction * antfile.size
+            throttle.update(transferred / total, antfile, fraction)
+
+        downloaded = 0
+        for i, antfile in enumerate(antfiles):
+            # anyone waiting on something in particular can go in
+            # between files
+            if i > 0:
+                self.run_jobs(Priority.BACKGROUND)
+
+            # the whole thing, or just this file, could have been
+            # cancelled. the size still counts towards the progress so
+            # it doesn't go backwards.
+            if job.is_cancelled(antfile) or not self.is_listed(antfile):
+                discard_partial(antfile.path)
+                done[0] += antfile.size
+                self.funcs.post(file_cb, antfile, None)
+                continue
+
+            try:
+                result = self.download_and_parse(antfile,
+                    lambda fraction, antfile=antfile: progress(antfile, fraction))
+            except Cancelled:
+                done[0] += antfile.size
+                self.funcs.post(file_cb, antfile, None)
+                continue
+            except:
+                # print out this traceback with more logging
+                self.change_status(Garmin.Status.DISCONNECTED)
+                for failed in antfiles[i:]:
+                    self.funcs.post(file_cb, failed, None)
+                break
+
+            done[0] += antfile.size
+            downloaded += 1
+            self.funcs.post(file_cb, antfile, result)
+
+        elapsed = time.time() - start
+        utils.debug('garmin: downloaded {} of {} files, {} bytes in {:.1f}s ({:.0f} B/s), '
+            '{} progress updates ({} dropped)',
+            downloaded, len(antfiles), done[0], elapsed,
+            done[0] / elapsed if elapsed else 0,
+            throttle.posted, throttle.dropped)
+
+        return downloaded
+
+    @queueable(lambda self: self.cancel_timer(True), Priority.INTERACTIVE)
     def delete_file(self, antfile):
         try:
             self.erase(antfile.index)
@@ -310,16 +1003,126 @@ class Garmin(ant.fs.manager.Application,
             return False
 
     def shutdown(self):
-        self.funcs = []
+        self.closing = True
+        self.funcs.clear()
         self.cancel_timer()
+        self.wakeup.set()
+
+        # otherwise it's done when the session finishes
+        if not self.in_session:
+            self.close()
+
+    def close(self):
+        self.reusable = False
+        ant.fs.manager.Application.stop(self)
+
+    def stop(self):
+        # openant calls this when it's given up on a session, but we
+        # want to keep the node open for next time. (reusable won't be
+        # set yet if it's setting up the node that's failed.)
+        if not getattr(self, 'reusable', False):
+            ant.fs.manager.Application.stop(self)
+
+    def reset_channel(self):
+        # once disconnected the device goes back to beaconing on the
+        # link frequency, which we moved away from in link()
+        try:
+            self._channel.close()
+        except Exception:
+            # already closed after not hearing anything
+            pass
+
+        # forget any beacons from last time
+        while not self._beacons.empty():
+            self._beacons.get_nowait()
+
+        self.setup_channel(self._channel)
+
+    def session(self):
+        # like ant.fs.manager.Application._main but without stopping the
+        # node at the end
+        self.enter_phase('search')
+        beacon = self._get_beacon()
+        self.enter_phase('link')
+        if self.on_link(beacon):
+            for i in range(0, 5):
+                beacon = self._get_beacon()
+                if beacon.get_client_device_state() == Beacon.ClientDeviceState.AUTHENTICATION:
+                    self.enter_phase('auth')
+                    if self.on_authentication(beacon):
+                        beacon = self._get_beacon()
+                        self.enter_phase('transport')
+                        self.on_transport(beacon)
+                    self.disconnect()
+                    break
 
-    @utils.run_in_thread
+    @utils.run_in_pool('device')
     def start(self):
-        if not self.funcs:
-            return
+        # sessions in a row which didn't get as far as transport
+        attempts = 0
+
+        # jobs can be queued while the last session is winding down so
+        # go round again if there are any left
+        while self.funcs and self.reusable and not self.closing:
+            if attempts:
+                delay = self.backoff(attempts)
+                utils.debug('garmin: attempt {} failed, trying again in {:.1f}s',
+                    attempts, delay)
+                self.wakeup.wait(delay)
+                if self.closing:
+                    break
+
+            self.change_status(Garmin.Status.CONNECTING)
+
+            self.session_start = time.time()
+            self.first_byte = False
+            self.transported = False
+            self.in_session = True
+
+            try:
+                if self.sessions:
+                    self.reset_channel()
+                self.sessions += 1
+
+                self.session()
+            except DeviceTimeout as e:
+                # the node's fine, the device just isn't talking
+                utils.debug('garmin: {}', e)
+            except Exception:
+                traceback.print_exc()
+                self.close()
+                self.change_status(Garmin.Status.DISCONNECTED)
+            finally:
+                self.in_session = False
+                self.deadline = None
+                self.log_phases()
+
+            # no point trying again until something changes
+            if self.status == Garmin.Status.AUTHENTICATION_FAILED:
+                break
+
+            if self.status != Garmin.Status.DISCONNECTED:
+                self.change_status(Garmin.Status.DISCONNECTED)
+
+            attempts = 0 if self.transported else attempts + 1
+            if attempts > self.retries:
+                break
+
+        if self.closing:
+            if self.reusable:
+                self.close()
+        elif self.funcs:
+            self.fail()
 
-        self.change_status(Garmin.Status.CONNECTING)
-        ant.fs.manager.Application.start(self)
+    def fail(self):
+        # don't leave anyone waiting on a device we're not going to
+        # talk to again
+        utils.debug('garmin: giving up, failing {} jobs', len(self.funcs))
+        if self.status != Garmin.Status.AUTHENTICATION_FAILED:
+            if self.reusable:
+                self.close()
+            self.change_status(Garmin.Status.FAILED)
+        self.funcs.abort()
 
     def disconnect(self):
         if self.status in (Garmin.Status.DISCONNECTED,
@@ -0,0 +1,160 @@
+# Copyright (C) 2015 Jonny Lamb <jonnylamb@jonnylamb.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# A sidecar is a small file saved next to each FIT file holding what
+# we've already decoded from it: the session summary and one array of
+# doubles per record field. The layout is:
+#
+#   magic, version, header length   (struct HEADER)
+#   header                          (JSON, padded to 8 bytes)
+#   column data                     (little endian doubles, in the
+#                                    order given in the header)
+#
+# Missing samples are stored as NaN.
+
+import os
+import sys
+import json
+import mmap
+import array
+import struct
+from datetime import datetime
+
+import numpy
+
+from utils import to_timestamp, from_timestamp
+
+SUFFIX = '.fuga'
+
+MAGIC = 'FUGA'
+VERSION = 1
+HEADER = struct.Struct('<4sII')
+
+COLUMNS = ('timestamp', 'position_lat', 'position_long', 'altitude',
+           'distance', 'heart_rate', 'cadence', 'speed', 'power')
+
+def path_for(fit_path):
+    return fit_path + SUFFIX
+
+def fit_stamp(fit_path):
+    st = os.stat(fit_path)
+    return st.st_size, st.st_mtime
+
+def encode_value(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': to_timestamp(value)}
+    return str(value)
+
+def decode_object(obj):
+    if '__datetime__' in obj:
+        return from_timestamp(obj['__datetime__'])
+    return obj
+
+def save(fit_path, summary, columns):
+    size, mtime = fit_stamp(fit_path)
+
+    names = [name for name in COLUMNS if name in columns]
+    count = len(columns[names[0]]) if names else 0
+
+    header = json.dumps({
+        'fit_size': size,
+        'fit_mtime': mtime,
+        'count': count,
+        'columns': names,
+        'summary': summary,
+    }, default=encode_value)
+    header += ' ' * (-(HEADER.size + len(header)) % 8)
+
+    path = path_for(fit_path)
+    tmp_path = path + '.tmp'
+
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+
+        for name in names:
+            column = columns[name]
+            if sys.byteorder != 'little':
+                column = array.array('d', column)
+                column.byteswap()
+            column.tofile(f)
+
+    os.rename(tmp_path, path)
+
+def read_header(f, fit_path):
+    data = f.read(HEADER.size)
+    if len(data) < HEADER.size:
+        return None
+
+    magic, version, header_len = HEADER.unpack(data)
+    if magic != MAGIC or version != VERSION:
+        return None
+
+    try:
+        header = json.loads(f.read(header_len), object_hook=decode_object)
+    except ValueError:
+        return None
+
+    if (header['fit_size'], header['fit_mtime']) != fit_stamp(fit_path):
+        return None
+
+    return header
+
+def load_summary(fit_path):
+    """Return just the summary from the sidecar of fit_path, or None if
+    there isn't an up-to-date one."""
+
+    try:
+        with open(path_for(fit_path), 'rb') as f:
+            header = read_header(f, fit_path)
+    except IOError:
+        return None
+
+    return header['summary'] if header else None
+
+def load(fit_path):
+    """Return (summary, columns) from the sidecar of fit_path, or None
+    if there isn't an up-to-date one. The columns are read-only NumPy
+    arrays over the mapped file, which stays mapped while they're in
+    use."""
+
+    try:
+        f = open(path_for(fit_path), 'rb')
+    except IOError:
+        return None
+
+    with f:
+        header = read_header(f, fit_path)
+        if not header:
+            return None
+
+        offset = f.tell()
+        count = header['count']
+        if offset + count * 8 * len(header['columns']) > os.fstat(f.fileno()).st_size:
+            return None
+
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    columns = {}
+    for name in header['columns']:
+        column = numpy.frombuffer(mapped, dtype='<f8', count=count,
+                                  offset=offset)
+        if sys.byteorder != 'little':
+            column = column.astype(numpy.float64)
+        columns[str(name)] = column
+        offset += count * 8
+
+    return header['summary'], columns
@@ -0,0 +1,119 @@
+# Copyright (C) 2015 Jonny Lamb <jonnylamb@jonnylamb.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Douglas-Peucker simplification of a route for each map zoom level.
+#
+# Rather than running the algorithm once per tolerance, each point is
+# given the largest tolerance at which Douglas-Peucker would still keep
+# it. That's the distance it was split at, capped by the same value for
+# the point which split its parent segment (a segment is only looked at
+# if its parent was split). Then the route at any tolerance is just the
+# points whose importance is greater than it.
+
+import math
+
+import numpy
+
+TILE_SIZE = 256
+MIN_ZOOM = 0
+# the highest zoom the default OpenStreetMap source goes to
+MAX_ZOOM = 18
+
+# how far, in pixels, the simplified path can stray from the real one
+TOLERANCE = 1.0
+
+def project(lat, lon):
+    # spherical mercator, in degrees so one pixel is the same size in
+    # both directions
+    y = numpy.degrees(numpy.log(numpy.tan(numpy.pi / 4 + numpy.radians(lat) / 2)))
+    return lon, y
+
+def tolerance_for_zoom(zoom):
+    return TOLERANCE * 360.0 / (TILE_SIZE * 2 ** zoom)
+
+MIN_TOLERANCE = tolerance_for_zoom(MAX_ZOOM)
+
+def importance(x, y):
+    n = len(x)
+    result = numpy.zeros(n)
+    if n == 0:
+        return result
+
+    # always keep both ends
+    result[0] = result[-1] = numpy.inf
+
+    stack = [(0, n - 1, numpy.inf)]
+    while stack:
+        first, last, parent = stack.pop()
+        if last - first < 2:
+            continue
+
+        ax, ay = x[first], y[first]
+        dx, dy = x[last] - ax, y[last] - ay
+        px, py = x[first + 1:last] - ax, y[first + 1:last] - ay
+
+        # distance to the segment, not the line, as activities often
+        # finish where they started
+        length = dx * dx + dy * dy
+        if length > 0:
+            t = numpy.clip((px * dx + py * dy) / length, 0, 1)
+            px = px - t * dx
+            py = py - t * dy
+        distances = px * px + py * py
+
+        i = int(numpy.argmax(distances))
+        d = min(math.sqrt(distances[i]), parent)
+        i += first + 1
+
+        # nothing in here will be shown at any zoom level
+        if d <= MIN_TOLERANCE:
+            continue
+
+        result[i] = d
+        stack.append((first, i, d))
+        stack.append((i, last, d))
+
+    return result
+
+class Route(object):
+    """A route which can be simplified for any zoom level. Levels are
+    cached once asked for."""
+
+    def __init__(self, lat, lon):
+        self.lat = lat
+        self.lon = lon
+        self.importance = importance(*project(lat, lon))
+        self.levels = {}
+
+        # (south, west, north, east), or None if there's no route
+        if len(lat):
+            self.bounds = (lat.min(), lon.min(), lat.max(), lon.max())
+        else:
+            self.bounds = None
+
+    def __len__(self):
+        return len(self.lat)
+
+    def level(self, zoom):
+        """(lat, long) arrays of the route simplified for zoom."""
+
+        zoom = max(MIN_ZOOM, min(MAX_ZOOM, zoom))
+
+        if zoom not in self.levels:
+            mask = self.importance > tolerance_for_zoom(zoom)
+            self.levels[zoom] = (self.lat[mask], self.lon[mask])
+
+        return self.levels[zoom]
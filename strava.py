@@ -17,6 +17,9 @@
 import os
 import json
 import sys
+import time
+import math
+from collections import deque
 
 from gi.repository import GObject, Soup, GLib, Gio
 
@@ -28,6 +31,178 @@ UPLOAD_URL_WITH_ID = 'https://www.strava.com/api/v3/uploads/{}'
 AUTH_URL = 'https://www.strava.com/oauth/authorize?client_id=362&response_type=code&redirect_uri=http://fuga.jonnylamb.com&approval_prompt=force&scope=write'
 CALLBACK_URL = 'http://fuga.jonnylamb.com/'
 
+class RateLimit(object):
+    """Strava allows so many requests every fifteen minutes and so many
+    a day, and says how many have been used in the X-RateLimit headers
+    of its responses. Requests are held back once either is nearly used
+    up rather than carrying on until we're told off with a 429."""
+
+    SHORT_WINDOW = 15 * 60 # s
+    LONG_WINDOW = 24 * 60 * 60 # s
+
+    # until we've been told
+    DEFAULT_LIMITS = (600, 30000)
+
+    # keep some spare in case something else is using the same token
+    HEADROOM = 0.05
+
+    def __init__(self):
+        self.limits = list(self.DEFAULT_LIMITS)
+        self.usage = [0, 0]
+        self.windows = self.current_windows(time.time())
+
+    def current_windows(self, now):
+        # both windows start on the quarter hour and at midnight utc
+        return (int(now // self.SHORT_WINDOW), int(now // self.LONG_WINDOW))
+
+    def roll(self, now):
+        windows = self.current_windows(now)
+        for i in (0, 1):
+            if windows[i] != self.windows[i]:
+                self.usage[i] = 0
+        self.windows = windows
+
+    def update(self, message):
+        """Catch up with the headers of a response."""
+
+        self.roll(time.time())
+
+        limit = message.response_headers.get_one('X-RateLimit-Limit')
+        usage = message.response_headers.get_one('X-RateLimit-Usage')
+        try:
+            limits = [int(x) for x in limit.split(',')]
+            usage = [int(x) for x in usage.split(',')]
+        except (AttributeError, ValueError):
+            limits = usage = None
+
+        if limits and len(limits) == 2 and len(usage) == 2:
+            self.limits = limits
+            # requests still on their way won't have been counted yet
+            self.usage = [max(a, b) for a, b in zip(self.usage, usage)]
+
+        if message.status_code == 429:
+            # we don't know which one it was; the short one is more
+            # likely and waiting for it costs less
+            self.usage[0] = max(self.usage[0], self.limits[0])
+            if self.usage[1] >= self.limits[1]:
+                self.usage[1] = self.limits[1]
+
+    def delay(self):
+        """How many seconds until another request can be made."""
+
+        now = time.time()
+        self.roll(now)
+
+        for i, window in ((1, self.LONG_WINDOW), (0, self.SHORT_WINDOW)):
+            if self.usage[i] >= self.limits[i] * (1 - self.HEADROOM):
+                return window - now % window
+
+        return 0
+
+    def request(self, send):
+        """Call send, which makes one request, now or as soon as
+        there's room."""
+
+        wait = self.delay()
+        if wait:
+            utils.debug('strava: rate limited ({}/{} and {}/{}), waiting {:.0f}s',
+                self.usage[0], self.limits[0], self.usage[1], self.limits[1],
+                wait)
+
+            def timeout_cb():
+                self.request(send)
+                return False
+            GLib.timeout_add_seconds(int(math.ceil(wait)), timeout_cb)
+            return
+
+        self.usage[0] += 1
+        self.usage[1] += 1
+        send()
+
+# shared by every upload as the limits are per token
+rate_limit = RateLimit()
+
+class StatusPoller(object):
+    """Asks after every upload Strava is still processing from the one
+    timer. Each upload is asked about less often the longer it takes,
+    up to MAX_INTERVAL, and ones which come due at about the same time
+    are done together."""
+
+    FIRST_INTERVAL = 1.0 # s
+    MAX_INTERVAL = 30.0 # s
+    BACKOFF = 2.0
+    SLACK = 0.25 # s
+
+    def __init__(self):
+        # uploader -> [when to poll next (None while asking), interval,
+        #              when it started waiting, number of polls]
+        self.pending = {}
+        self.source = 0
+
+        # stats
+        self.ready_times = []
+        self.polls = 0
+
+    def add(self, uploader):
+        """Ask about uploader again later; called each time it's
+        found to be still processing."""
+
+        now = time.time()
+        entry = self.pending.get(uploader)
+        if entry is None:
+            entry = self.pending[uploader] = [None, self.FIRST_INTERVAL, now, 0]
+        else:
+            entry[1] = min(self.MAX_INTERVAL, entry[1] * self.BACKOFF)
+
+        entry[0] = now + entry[1]
+        self.reschedule()
+
+    def remove(self, uploader, ready=False):
+        entry = self.pending.pop(uploader, None)
+        if entry is None:
+            return
+
+        if ready:
+            elapsed = time.time() - entry[2]
+            self.ready_times.append(elapsed)
+            times = sorted(self.ready_times)
+            utils.debug('strava: {} ready after {:.1f}s and {} polls '
+                '(median {:.1f}s, max {:.1f}s over {} uploads, {} polls)',
+                uploader.id, elapsed, entry[3], times[len(times) // 2],
+                times[-1], len(times), self.polls)
+
+        self.reschedule()
+
+    def reschedule(self):
+        if self.source:
+            GLib.source_remove(self.source)
+            self.source = 0
+
+        due = [entry[0] for entry in self.pending.values()
+               if entry[0] is not None]
+        if not due:
+            return
+
+        delay = max(0.0, min(due) - time.time())
+        self.source = GLib.timeout_add(int(delay * 1000), self.timeout_cb)
+
+    def timeout_cb(self):
+        self.source = 0
+
+        now = time.time()
+        for uploader, entry in self.pending.items():
+            if entry[0] is not None and entry[0] <= now + self.SLACK:
+                # not again until we've heard back
+                entry[0] = None
+                entry[3] += 1
+                self.polls += 1
+                uploader.poll_status()
+
+        self.reschedule()
+        return False
+
+poller = StatusPoller()
+
 class Uploader(GObject.GObject):
 
     class Status:
@@ -57,10 +232,20 @@ class Uploader(GObject.GObject):
         self.error = None
         self.activity_id = None
 
+        # makes the last request again if it was rate limited
+        self.retry = None
+
     def change_status(self, status):
         if status == self.status:
             return
         self.status = status
+
+        if status in (Uploader.Status.DONE,
+                      Uploader.Status.ERROR,
+                      Uploader.Status.DUPLICATE,
+                      Uploader.Status.AUTH_ERROR):
+            poller.remove(self, status == Uploader.Status.DONE)
+
         self.emit('status-changed', status)
 
     def start(self):
@@ -85,21 +270,33 @@ class Uploader(GObject.GObject):
         message = Soup.form_request_new_from_multipart(UPLOAD_URL, multipart)
         message.request_headers.append('Authorization', 'Bearer {}'.format(self.token))
 
-        self.session.send_async(message, callback=self.sent_cb)
+        self.send(message, lambda: self.file_loaded(data))
 
         self.change_status(Uploader.Status.UPLOADING)
 
+    def send(self, message, retry):
+        self.retry = retry
+        rate_limit.request(lambda: self.session.send_async(message,
+            callback=self.sent_cb, user_data=message))
+
     def error_from_exception(self, e):
         self.error = e.message
         self.change_status(Uploader.Status.ERROR)
 
-    def sent_cb(self, session, result):
+    def sent_cb(self, session, result, message):
         try:
             stream = session.send_finish(result)
         except Exception as e:
             self.error_from_exception(e)
             return
 
+        rate_limit.update(message)
+
+        if message.status_code == 429:
+            stream.close()
+            self.retry()
+            return
+
         def cb(data):
             stream.close()
             self.read_response(data)
@@ -140,14 +337,95 @@ class Uploader(GObject.GObject):
 
         if 'still' in data['status']:
             self.change_status(Uploader.Status.WAITING)
-            GLib.timeout_add_seconds(1, self.poll_status)
+            poller.add(self)
 
     def poll_status(self):
         message = Soup.Message.new('GET', UPLOAD_URL_WITH_ID.format(self.id))
         message.request_headers.append('Authorization', 'Bearer {}'.format(self.token))
 
-        self.session.send_async(message, callback=self.sent_cb)
-        return False
+        self.send(message, self.poll_status)
+
+class BatchUploader(GObject.GObject):
+    """Uploads lots of activities, a few at a time. Each one goes
+    through its Activity's own Uploader so the rest of the ui sees it
+    as usual."""
+
+    CONCURRENT = 3
+
+    FINISHED = (Uploader.Status.DONE,
+                Uploader.Status.ERROR,
+                Uploader.Status.DUPLICATE,
+                Uploader.Status.AUTH_ERROR)
+
+    @GObject.Signal(arg_types=(int, int))
+    def progress(self, done, total):
+        pass
+
+    @GObject.Signal
+    def finished(self):
+        pass
+
+    def __init__(self, activities):
+        GObject.GObject.__init__(self)
+
+        self.pending = deque(activities)
+        self.running = set()
+        self.total = len(self.pending)
+        self.done = 0
+        self.complete = False
+
+        # status -> how many finished like that
+        self.results = dict.fromkeys(self.FINISHED, 0)
+        self.auth_error = False
+
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.time()
+        self.fill()
+
+    def cancel(self):
+        # the ones already going carry on
+        self.total -= len(self.pending)
+        self.pending.clear()
+        self.fill()
+
+    def fill(self):
+        while self.pending and len(self.running) < self.CONCURRENT:
+            uploader = self.pending.popleft().upload()
+            uploader.connect('status-changed', self.status_changed_cb)
+            self.running.add(uploader)
+
+            # it might have been started already from the details
+            if uploader.status == Uploader.Status.NONE:
+                uploader.start()
+
+        if not self.running and not self.complete:
+            self.complete = True
+            utils.debug('strava: uploaded {} of {} in {:.1f}s ({} duplicates, {} failed)',
+                self.results[Uploader.Status.DONE], self.total,
+                time.time() - self.start_time,
+                self.results[Uploader.Status.DUPLICATE],
+                self.results[Uploader.Status.ERROR])
+            self.emit('finished')
+
+    def status_changed_cb(self, uploader, status):
+        if status not in self.FINISHED:
+            return
+
+        uploader.disconnect_by_func(self.status_changed_cb)
+        self.running.discard(uploader)
+        self.results[status] += 1
+        self.done += 1
+
+        # the rest would only fail the same way
+        if status == Uploader.Status.AUTH_ERROR:
+            self.auth_error = True
+            self.total -= len(self.pending)
+            self.pending.clear()
+
+        self.emit('progress', self.done, self.total)
+        self.fill()
 
 if __name__ == '__main__':
     token, path = sys.argv[1:]
@@ -15,6 +15,8 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import json
+import time
+from itertools import izip
 
 # for champlain
 from gi.repository import GtkClutter
@@ -23,7 +25,13 @@ GtkClutter.init([])
 from gi.repository import Gtk, GLib, Pango, Gdk, GtkChamplain, Champlain, WebKit
 
 from activity import Activity
+from bulkparse import BulkParser
 import strava
+import utils
+
+# keep the decoded tracks in memory after a bulk parse if there aren't
+# too many of them; otherwise they're left in their sidecars
+KEEP_TRACKS_LIMIT = 50
 
 class Activities(Gtk.Bin):
     def __init__(self, app):
@@ -42,8 +50,32 @@ class Activities(Gtk.Bin):
 
         self.pane.activity_list.connect('row-selected', self.row_selected_cb)
 
+        self.bulk_parser = None
+        self.pane.cancel_button.connect('clicked', self.cancel_parse_clicked_cb)
+        self.connect('destroy', self.cancel_parse_clicked_cb)
+
+        # antfile -> activity for the bulk download going on
+        self.downloading = None
+        self.download_job = None
+        self.num_downloaded = 0
+        self.pane.download_cancel_button.connect('clicked',
+            self.cancel_download_clicked_cb)
+
+        self.batch_uploader = None
+        self.pane.upload_button.connect('clicked', self.upload_selected_clicked_cb)
+        self.pane.upload_cancel_button.connect('clicked',
+            self.cancel_upload_clicked_cb)
+
+        # the details view, and its map, are kept around and just given
+        # each activity in turn; everything else is made as needed
+        self.stack = Gtk.Stack()
+        self.hbox.pack_start(self.stack, True, True, 0)
+
+        self.details = None
+        self.shown = None
+
         self.content = NoActivities()
-        self.hbox.pack_start(self.content, True, True, 0)
+        self.stack.add(self.content)
 
     def set_header(self, header):
         # ugly but for convenience
@@ -52,6 +84,7 @@ class Activities(Gtk.Bin):
         self.num_selected = 0
         self.header.select_button.connect('toggled', self.select_toggled_cb)
         self.header.delete_button.connect('clicked', self.delete_clicked_cb)
+        self.header.download_button.connect('clicked', self.download_clicked_cb)
 
         # keep left pane and toolbar the same width
         hsize_group = Gtk.SizeGroup(Gtk.SizeGroupMode.HORIZONTAL)
@@ -63,29 +96,157 @@ class Activities(Gtk.Bin):
         row.selector_button.connect('toggled', self.activity_toggled_cb)
         self.pane.activity_list.prepend(row)
 
-        # not at all necessary to enable unless the listview row starts
-        # showing actual details about the activity
-        #self.parse_all()
-
         self.header.select_button.set_sensitive(True)
+        if not row.downloaded:
+            self.header.download_button.set_sensitive(True)
+
+        return row
+
+    def reconcile(self, changed, removed):
+        """Bring the list up to date with the device after showing it
+        from the saved listing. changed are the activities which are
+        new or different since then and removed the filenames of those
+        which have gone."""
+
+        rows = dict((row.filename, row)
+                    for row in self.pane.activity_list.get_children())
+        added = 0
+
+        for antfile in changed:
+            row = rows.get(antfile.filename)
+            if not row:
+                self.add_activity(antfile).show_all()
+                added += 1
+            elif not row.download_job:
+                # a download in progress keeps the one it started with
+                row.antfile = antfile
+
+        # a download in progress will find out for itself
+        gone = [rows[filename] for filename in removed
+                if filename in rows and not rows[filename].download_job]
+        for row in gone:
+            if row is self.shown:
+                self.reset_content(None)
+            self.pane.activity_list.remove(row)
+
+        utils.debug('activities: reconciled with device, {} added, {} removed',
+            added, len(gone))
+
+        if not self.pane.activity_list.get_selected_row():
+            self.select_first()
+        self.parse_all()
 
     def select_first(self):
         activity = self.pane.activity_list.get_row_at_index(0)
         if activity:
             self.pane.activity_list.select_row(activity)
 
-    def parse_all(self, unused=None):
-        def idle():
-            for activity in self.pane.activity_list.get_children():
-                if not activity.downloaded:
-                    continue
+    def parse_all(self):
+        if self.bulk_parser:
+            return
+
+        activities = [a for a in self.pane.activity_list.get_children()
+                      if a.needs_summary]
+        if not activities:
+            return
+
+        self.bulk_parser = BulkParser(self.app.index, activities,
+            tracks=len(activities) <= KEEP_TRACKS_LIMIT)
+        self.bulk_parser.connect('progress', self.parse_progress_cb)
+        self.bulk_parser.connect('finished', self.parse_finished_cb)
+        self.bulk_parser.start()
+
+        self.pane.progress.set_fraction(0)
+        self.pane.progress_revealer.set_reveal_child(True)
+
+    def parse_progress_cb(self, parser, done, total):
+        self.pane.progress.set_fraction(float(done) / total)
+        self.pane.progress.set_text('Reading activities ({} of {})'.format(
+            done, total))
+
+    def parse_finished_cb(self, parser):
+        self.bulk_parser = None
+        self.pane.progress_revealer.set_reveal_child(False)
+
+    def cancel_parse_clicked_cb(self, widget):
+        if self.bulk_parser:
+            self.bulk_parser.cancel()
+
+    def download_clicked_cb(self, button):
+        self.download_new()
+
+    def download_new(self):
+        if self.downloading:
+            return
+
+        activities = [a for a in self.pane.activity_list.get_children()
+                      if a.status in (Activity.Status.NONE,
+                                      Activity.Status.DOWNLOAD_FAILED)]
+        if not activities:
+            return
+
+        self.downloading = dict((a.antfile, a) for a in activities)
+        self.num_downloaded = 0
+
+        for activity in activities:
+            activity.change_status(Activity.Status.DOWNLOADING)
+
+        self.download_job = self.app.queue.download_files(
+            self.download_finished_cb, [a.antfile for a in activities],
+            self.file_downloaded_cb, self.download_progress_cb)
+
+        for activity in activities:
+            activity.download_job = self.download_job
+
+        self.header.download_button.set_sensitive(False)
+
+        self.pane.download_progress.set_fraction(0)
+        self.pane.download_progress.set_text('Waiting to download...')
+        self.pane.download_revealer.set_reveal_child(True)
+
+    def file_downloaded_cb(self, antfile, result):
+        self.num_downloaded += 1
+        self.downloading[antfile].file_downloaded_cb(result)
 
-                if activity.status == Activity.Status.DOWNLOADED:
-                    activity.connect('status-changed', self.parse_all)
-                    activity.parse()
-                    return
+    def download_progress_cb(self, antfile, fraction, total_fraction,
+                             rate, eta):
+        file_eta = (1.0 - fraction) * antfile.size / rate if rate > 0 else -1.0
+        self.downloading[antfile].emit('download-progress', fraction,
+                                       rate, file_eta)
 
-        GLib.idle_add(idle)
+        text = 'Downloading {} of {} ({}/s'.format(
+            self.num_downloaded + 1, len(self.downloading),
+            GLib.format_size(int(rate)))
+        if eta >= 0:
+            text += ', ' + utils.format_time_left(eta)
+        text += ')'
+
+        self.pane.download_progress.set_fraction(total_fraction)
+        self.pane.download_progress.set_text(text)
+
+    def cancel_download_clicked_cb(self, button):
+        if not self.downloading:
+            return
+
+        self.app.queue.cancel(self.download_job)
+
+        for activity in self.downloading.values():
+            activity.download_job = None
+            activity.cancel_download()
+
+    def download_finished_cb(self, num_downloaded):
+        # None if it never got going, like when the device couldn't be
+        # found, so nothing's going to be heard about the files
+        if num_downloaded is None:
+            for activity in self.downloading.values():
+                activity.file_downloaded_cb(None)
+
+        self.downloading = None
+        self.download_job = None
+        self.pane.download_revealer.set_reveal_child(False)
+
+        self.header.download_button.set_sensitive(any(
+            not a.downloaded for a in self.pane.activity_list.get_children()))
 
     def activity_toggled_cb(self, selector):
         if selector.get_active():
@@ -100,6 +261,68 @@ class Activities(Gtk.Bin):
             self.header.left_toolbar.set_title('Select')
             self.pane.delete_button.set_sensitive(False)
 
+        self.pane.upload_button.set_sensitive(
+            self.num_selected > 0 and not self.batch_uploader)
+
+    def upload_selected_clicked_cb(self, button):
+        config = self.app.config
+
+        if not config.has_option('strava', 'access_token') or \
+           not config.get('strava', 'access_token'):
+            dialog = StravaAuthDialog(self.app)
+            dialog.connect('response', self.auth_dialog_response_cb)
+            dialog.set_transient_for(self.get_toplevel())
+            dialog.show_all()
+            return
+
+        activities = [a for a in self.pane.activity_list.get_children()
+                      if a.selector_button.get_active() and a.downloaded
+                      and not a.strava_id]
+        self.header.select_button.set_active(False)
+
+        self.upload_all(activities)
+
+    def auth_dialog_response_cb(self, dialog, response_id):
+        dialog.destroy()
+
+        if response_id == Gtk.ResponseType.ACCEPT:
+            self.upload_selected_clicked_cb(self.pane.upload_button)
+
+    def upload_all(self, activities):
+        if self.batch_uploader or not activities:
+            return
+
+        self.batch_uploader = strava.BatchUploader(activities)
+        self.batch_uploader.connect('progress', self.upload_progress_cb)
+        self.batch_uploader.connect('finished', self.upload_finished_cb)
+
+        self.pane.upload_progress.set_fraction(0)
+        self.pane.upload_progress.set_text('Uploading {} activities...'.format(
+            len(activities)))
+        self.pane.upload_revealer.set_reveal_child(True)
+
+        self.batch_uploader.start()
+
+    def upload_progress_cb(self, uploader, done, total):
+        text = 'Uploaded {} of {}'.format(done, total)
+        if strava.rate_limit.delay():
+            text += ' (waiting for Strava)'
+
+        self.pane.upload_progress.set_fraction(float(done) / max(total, 1))
+        self.pane.upload_progress.set_text(text)
+
+    def cancel_upload_clicked_cb(self, button):
+        if self.batch_uploader:
+            self.batch_uploader.cancel()
+
+    def upload_finished_cb(self, uploader):
+        if uploader.auth_error:
+            self.app.config.set('strava', 'access_token', '')
+            self.app.config.save()
+
+        self.batch_uploader = None
+        self.pane.upload_revealer.set_reveal_child(False)
+
     def select_toggled_cb(self, toggle_button):
         if toggle_button.get_active():
             self.header.left_toolbar.get_style_context().add_class('selection-mode')
@@ -152,7 +375,12 @@ class Activities(Gtk.Bin):
             return
 
         if activity:
+            start = time.time()
             self.reset_content(activity)
+            elapsed = time.time() - start
+            if elapsed > utils.FRAME_TIME:
+                utils.debug('activities: selecting {} took {:.1f}ms',
+                    activity.filename, elapsed * 1000)
         else:
             activity = self.pane.activity_list.get_row_at_index(self.selected)
             if activity:
@@ -160,16 +388,45 @@ class Activities(Gtk.Bin):
                 activity.changed()
 
     def activity_status_changed_cb(self, activity, status):
+        # the details view looks after itself while parsing
+        if isinstance(self.content, ActivityDetails) and \
+           status in (Activity.Status.PARSING, Activity.Status.PARSED):
+            self.update_delete_button(activity)
+            return
+
         self.reset_content(activity)
 
+    def update_delete_button(self, activity):
+        self.header.delete_button.set_visible(
+            activity.status == Activity.Status.NONE or
+            (activity.status == Activity.Status.PARSED and \
+            not self.header.select_button.get_active()))
+
     def reset_content(self, activity):
-        if self.content:
+        # once the focused activity is changed we want to stop listening to
+        # its status-changed signal. in most cases this isn't a problem but if
+        # you select an activity, press download, and change activity, once
+        # the first activity is downloaded the content will change.
+        if self.shown:
+            try:
+                self.shown.disconnect_by_func(self.activity_status_changed_cb)
+            except TypeError:
+                pass
+            self.shown = None
+
+        if self.content is self.details:
+            self.details.unwatch()
+        elif self.content:
             self.content.destroy()
-            self.content = None
+        self.content = None
 
         if not activity:
             return
 
+        activity.check_file()
+        if not activity.downloaded:
+            self.header.download_button.set_sensitive(True)
+
         # on device but not computer
         if activity.status == Activity.Status.NONE:
             self.content = ActivityMissingDetails(activity)
@@ -178,20 +435,18 @@ class Activities(Gtk.Bin):
         elif activity.status == Activity.Status.DOWNLOADING:
             self.content = ActivityDownloadingDetails(activity)
 
-        # finished downloading
-        elif activity.status == Activity.Status.DOWNLOADED:
-            activity.parse()
-            self.content = Gtk.Spinner()
-            self.content.start()
-
-        # currently parsing
-        elif activity.status == Activity.Status.PARSING:
-            self.content = Gtk.Spinner()
-            self.content.start()
+        # finished downloading, currently parsing or finished parsing;
+        # the details are filled in as the file is parsed
+        elif activity.status in (Activity.Status.DOWNLOADED,
+                                 Activity.Status.PARSING,
+                                 Activity.Status.PARSED):
+            if not self.details:
+                self.details = ActivityDetails()
+                self.stack.add(self.details)
+                self.details.show_all()
 
-        # finished parsing
-        elif activity.status == Activity.Status.PARSED:
-            self.content = ActivityDetails(activity)
+            self.details.set_activity(activity)
+            self.content = self.details
 
         # failed to parse
         elif activity.status in (Activity.Status.DOWNLOAD_FAILED,
@@ -203,13 +458,12 @@ class Activities(Gtk.Bin):
             self.pane.activity_list.remove(activity)
             return
 
-        self.header.delete_button.set_visible(
-            activity.status == Activity.Status.NONE or
-            (activity.status == Activity.Status.PARSED and \
-            not self.header.select_button.get_active()))
+        self.update_delete_button(activity)
 
-        self.hbox.pack_start(self.content, True, True, 0)
-        self.content.show_all()
+        if self.content is not self.details:
+            self.stack.add(self.content)
+            self.content.show_all()
+        self.stack.set_visible_child(self.content)
 
         title = activity.date.strftime('%A %d %B at %H:%M')
         self.header.right_toolbar.set_title(title)
@@ -219,18 +473,8 @@ class Activities(Gtk.Bin):
         # have the same index that we're saving now)
         self.selected = activity.get_index()
 
-        # once the focused activity is changed we want to stop listening to
-        # its status-changed signal. in most cases this isn't a problem but if
-        # you select an activity, press download, and change activity, once
-        # the first activity is downloaded the content will change.
-        def content_destroy_cb(widget, activity):
-            try:
-                activity.disconnect_by_func(self.activity_status_changed_cb)
-            except TypeError:
-                pass
-        self.content.connect('destroy', content_destroy_cb, activity)
-
         activity.connect('status-changed', self.activity_status_changed_cb)
+        self.shown = activity
 
 class ActivitiesHeader(Gtk.Box):
     def __init__(self, page):
@@ -256,6 +500,13 @@ class ActivitiesHeader(Gtk.Box):
         self.select_button.set_image(image)
         self.left_toolbar.pack_end(self.select_button)
 
+        # download new button
+        self.download_button = Gtk.Button.new_from_icon_name(
+            'folder-download-symbolic', Gtk.IconSize.MENU)
+        self.download_button.set_tooltip_text('Download new activities')
+        self.download_button.set_sensitive(False)
+        self.left_toolbar.pack_end(self.download_button)
+
         # right toolbar
         self.right_toolbar = Gtk.HeaderBar()
         self.right_toolbar.set_show_close_button(True)
@@ -272,6 +523,7 @@ class ActivitiesHeader(Gtk.Box):
         # keep all menu buttons the same height
         vsize_group = Gtk.SizeGroup(Gtk.SizeGroupMode.VERTICAL)
         vsize_group.add_widget(self.select_button)
+        vsize_group.add_widget(self.download_button)
         vsize_group.add_widget(self.delete_button)
 
 class ListPane(Gtk.Frame):
@@ -295,6 +547,14 @@ class ListPane(Gtk.Frame):
         self.activity_list = ActivityList()
         scrolled.add(self.activity_list)
 
+        # bulk parse, download and upload progress
+        self.progress_revealer, self.progress, self.cancel_button = \
+            self.add_progress_bar(grid)
+        self.download_revealer, self.download_progress, \
+            self.download_cancel_button = self.add_progress_bar(grid)
+        self.upload_revealer, self.upload_progress, \
+            self.upload_cancel_button = self.add_progress_bar(grid)
+
         # revealer
         self.revealer = Gtk.Revealer()
         self.revealer.set_transition_type(Gtk.RevealerTransitionType.SLIDE_UP)
@@ -303,12 +563,36 @@ class ListPane(Gtk.Frame):
         bar = Gtk.ActionBar()
         self.revealer.add(bar)
 
-        # TODO: add upload button
+        self.upload_button = Gtk.Button('Upload to Strava')
+        self.upload_button.set_sensitive(False)
+        bar.pack_start(self.upload_button)
+
         self.delete_button = Gtk.Button('Delete')
         self.delete_button.get_style_context().add_class('destructive-action')
         self.delete_button.set_sensitive(False)
         bar.pack_end(self.delete_button)
 
+    def add_progress_bar(self, grid):
+        # a progress bar and stop button which slide up from the bottom
+        revealer = Gtk.Revealer()
+        revealer.set_transition_type(Gtk.RevealerTransitionType.SLIDE_UP)
+        grid.add(revealer)
+
+        bar = Gtk.ActionBar()
+        revealer.add(bar)
+
+        progress = Gtk.ProgressBar()
+        progress.set_show_text(True)
+        progress.set_hexpand(True)
+        progress.set_valign(Gtk.Align.CENTER)
+        bar.pack_start(progress)
+
+        cancel_button = Gtk.Button.new_from_icon_name('process-stop-symbolic',
+            Gtk.IconSize.MENU)
+        bar.pack_end(cancel_button)
+
+        return revealer, progress, cancel_button
+
 class ActivityList(Gtk.ListBox):
     def __init__(self):
         Gtk.ListBox.__init__(self)
@@ -339,6 +623,7 @@ class ActivityRow(Gtk.ListBoxRow, Activity):
     status_changed = Activity.status_changed
     strava_id_updated = Activity.strava_id_updated
     download_progress = Activity.download_progress
+    summary_updated = Activity.summary_updated
 
     ICON_SIZE = Gtk.IconSize.DND
 
@@ -384,6 +669,7 @@ class ActivityRow(Gtk.ListBoxRow, Activity):
             self.image.set_from_icon_name('dialog-question-symbolic', self.ICON_SIZE)
 
         self.connect('status-changed', self.status_changed_cb)
+        self.connect('summary-updated', self.summary_updated_cb)
         self.status_changed_cb(self, self.status)
 
     def set_image_from_sport(self, image, size):
@@ -397,6 +683,9 @@ class ActivityRow(Gtk.ListBoxRow, Activity):
         else:
             image.set_from_icon_name('preferences-system-time-symbolic', size)
 
+    def summary_updated_cb(self, activity):
+        self.status_changed_cb(self, self.status)
+
     def status_changed_cb(self, activity, status):
         downloading = (status == Activity.Status.DOWNLOADING)
         self.spinner.set_visible(downloading)
@@ -507,6 +796,9 @@ class UploadInfoBar(Gtk.InfoBar):
         if response != Gtk.ResponseType.CLOSE:
             return
 
+        self.stop()
+
+    def stop(self):
         self.hide()
 
         if self.uploader:
@@ -719,22 +1011,39 @@ class ActivityDownloadingDetails(Gtk.Box):
             return True
         self.pulse_timeout_id = GLib.timeout_add(100, pulse)
 
-        # TODO: we can't actually cancel these downloads though
-        #bar = Gtk.ActionBar()
-        #self.pack_start(bar, False, False, 0)
+        bar = Gtk.ActionBar()
+        self.pack_start(bar, False, False, 0)
 
-        #button = Gtk.Button('Cancel download')
-        #bar.pack_end(button)
+        button = Gtk.Button('Cancel download')
+        button.connect('clicked', self.cancel_clicked_cb)
+        bar.pack_end(button)
 
         self.activity.connect('download-progress', self.download_progress_cb)
+        self.connect('destroy', self.destroy_cb)
 
-    def download_progress_cb(self, activity, fraction):
+    def destroy_cb(self, widget):
         if self.pulse_timeout_id:
             GLib.source_remove(self.pulse_timeout_id)
             self.pulse_timeout_id = 0
 
+        self.activity.disconnect_by_func(self.download_progress_cb)
+
+    def cancel_clicked_cb(self, button):
+        self.activity.cancel_download()
+
+    def download_progress_cb(self, activity, fraction, rate, eta):
+        if self.pulse_timeout_id:
+            GLib.source_remove(self.pulse_timeout_id)
+            self.pulse_timeout_id = 0
+
+        text = 'Downloading...'
+        if rate > 0:
+            text = 'Downloading at {}/s'.format(GLib.format_size(int(rate)))
+            if eta >= 0:
+                text += ', ' + utils.format_time_left(eta)
+
         self.progress.set_fraction(fraction)
-        self.label.set_markup('<i>Downloading...</i>')
+        self.label.set_markup('<i>{}</i>'.format(text))
 
 class ActivityFailed(Gtk.Grid):
     def __init__(self, activity):
@@ -788,14 +1097,26 @@ class ActivityFailed(Gtk.Grid):
         self.activity.download()
 
 class ActivityDetails(Gtk.Box):
-    def __init__(self, activity):
+    # while parsing only every this many records goes on the map, as
+    # a preview until the simplified route replaces it
+    PREVIEW_STEP = 10
+
+    def __init__(self):
         Gtk.Box.__init__(self)
 
         self.set_orientation(Gtk.Orientation.VERTICAL)
         self.get_style_context().add_class('view')
         self.get_style_context().add_class('contacts-main-view')
 
-        self.activity = activity
+        self.activity = None
+        # (object, handler id) for everything connected to the current
+        # activity, dropped when we're given another one
+        self.handlers = []
+
+        # zoom -> idle source adding that level's route to the map
+        self.filling = {}
+        self.route = None
+        self.route_request = None
 
         self.infobar = UploadInfoBar()
         self.pack_start(self.infobar, False, False, 0)
@@ -809,9 +1130,8 @@ class ActivityDetails(Gtk.Box):
         grid.set_property('margin', 24)
         self.pack_start(grid, True, True, 0)
 
-        image = Gtk.Image()
-        activity.set_image_from_sport(image, Gtk.IconSize.DIALOG)
-        grid.attach(image, 0, 0, 1, 1)
+        self.image = Gtk.Image()
+        grid.attach(self.image, 0, 0, 1, 1)
 
         label = Gtk.Label('')
         label.set_hexpand(True)
@@ -847,20 +1167,65 @@ class ActivityDetails(Gtk.Box):
         grid.attach(label, 2, 1, 1, 1)
         self.moving_time_label = label
 
-        # map overlay
+        # map overlay. creating one of these is slow so the same one is
+        # used for every activity shown.
         self.embed = GtkChamplain.Embed()
+        self.embed.set_no_show_all(True)
         grid.attach(self.embed, 0, 2, 3, 1)
-        self.embed.show_all()
+
+        self.view = self.embed.get_view()
+        self.view.connect('notify::zoom-level', self.zoom_level_changed_cb)
+        self.layer = None
+        self.layers = {}
 
         # action bar
         bar = Gtk.ActionBar()
         self.pack_start(bar, False, False, 0)
 
         self.upload_button = Gtk.Button('Upload to Strava')
-        self.strava_id_updated_cb(None, None)
         bar.pack_end(self.upload_button)
         self.upload_button.connect('clicked', self.upload_view_clicked_cb)
-        self.activity.connect('strava-id-updated', self.strava_id_updated_cb)
+
+        self.connect('destroy', lambda *x: self.unwatch())
+
+    def watch(self, obj, signal, callback):
+        self.handlers.append((obj, obj.connect(signal, callback)))
+
+    def unwatch(self):
+        for obj, handler_id in self.handlers:
+            obj.disconnect(handler_id)
+        self.handlers = []
+
+    def set_activity(self, activity):
+        self.unwatch()
+
+        self.activity = activity
+
+        # forget everything about the last activity
+        self.infobar.stop()
+
+        activity.set_image_from_sport(self.image, Gtk.IconSize.DIALOG)
+        for label in (self.distance_label, self.elapsed_time_label,
+                      self.elevation_label, self.moving_time_label):
+            label.set_text('')
+
+        self.upload_button.set_label('Upload to Strava')
+        self.upload_button.set_sensitive(True)
+        self.strava_id_updated_cb(None, None)
+        self.watch(activity, 'strava-id-updated', self.strava_id_updated_cb)
+
+        for source in self.filling.values():
+            GLib.source_remove(source)
+        self.filling = {}
+
+        if self.layer:
+            self.view.remove_layer(self.layer)
+        self.layer = None
+        self.layers = {}
+        self.route = None
+        self.route_request = None
+
+        self.embed.show_all()
 
         # once parsed fill in the blanks
         self.fill_details()
@@ -877,7 +1242,7 @@ class ActivityDetails(Gtk.Box):
 
                 uploader = self.activity.upload()
                 uploader.start()
-                uploader.connect('status-changed', self.uploader_status_changed_cb)
+                self.watch(uploader, 'status-changed', self.uploader_status_changed_cb)
 
                 self.infobar.start(uploader)
                 button.set_sensitive(False)
@@ -917,68 +1282,177 @@ class ActivityDetails(Gtk.Box):
             message.show_all()
 
     def fill_details(self):
+        self.layer = Champlain.PathLayer()
+        self.view.add_layer(self.layer)
 
-        def status_changed_cb(activity, status=Activity.Status.PARSED):
-            if status != Activity.Status.PARSED:
-                return
-
-            f = activity.fit
-
-            layer = Champlain.PathLayer()
-
-            for message in f.records():
-                vals = message.get_values()
-                try:
-                    coord = Champlain.Coordinate.new_full(
-                        vals['position_lat'],
-                        vals['position_long'])
-                    layer.add_node(coord)
-                except KeyError:
-                    continue
-
-            if layer.get_nodes():
-                view = self.embed.get_view()
-                view.add_layer(layer)
-
-                # https://bugzilla.gnome.org/show_bug.cgi?id=754718
-                # for some reason connecting to to ::realize on view
-                # or embed isn't enough. in fact this idle only works
-                # most of the time but for now it's good enough.
-                view.set_zoom_level(15)
-                GLib.idle_add(lambda: view.ensure_layers_visible(False))
-            else:
-                self.embed.destroy()
-
-            # now labels
-            self.distance_label.set_markup('<span font="16">{0:.1f} km</span>\n' \
-                '<span color="gray">Distance</span>'.format(f.get_distance() / 1000))
-
-            hours, mins, secs = f.get_elapsed_time()
-            self.elapsed_time_label.set_markup('<span font="16">{0}:{1:02d}:{2:02d}</span>\n' \
-                '<span color="gray">Elapsed Time</span>'.format(hours, mins, secs))
+        self.first_timestamp = None
+        self.records_seen = 0
+        self.preview_nodes = 0
 
-            elevation = f.get_elevation()
-            self.elevation_label.set_markup('{}m\n' \
-                '<span color="gray">Elevation</span>'.format(elevation))
-
-            hours, mins, secs = f.get_moving_time()
-            self.moving_time_label.set_markup('{0}:{1:02d}:{2:02d}\n' \
-                '<span color="gray">Moving Time</span>'.format(hours, mins, secs))
-
-            if activity.uploader is not None:
-                activity.uploader.connect('status-changed',
-                    lambda *x: self.strava_id_updated_cb(None, None))
+        if self.activity.status == Activity.Status.PARSED:
+            self.parsed()
+            return
 
-                self.infobar.start(activity.uploader)
-                self.infobar.connect('response',
-                    lambda *x: self.strava_id_updated_cb(None, None))
+        self.watch(self.activity.fit, 'records-decoded', self.records_decoded_cb)
+        self.watch(self.activity, 'status-changed', self.activity_status_changed_cb)
+
+        self.activity.parse()
+
+    def add_node(self, vals):
+        try:
+            coord = Champlain.Coordinate.new_full(
+                vals['position_lat'],
+                vals['position_long'])
+        except KeyError:
+            return False
+
+        self.layer.add_node(coord)
+        return True
+
+    def set_distance(self, km):
+        self.distance_label.set_markup('<span font="16">{0:.1f} km</span>\n' \
+            '<span color="gray">Distance</span>'.format(km))
+
+    def set_elapsed_time(self, hours, mins, secs):
+        self.elapsed_time_label.set_markup('<span font="16">{0}:{1:02d}:{2:02d}</span>\n' \
+            '<span color="gray">Elapsed Time</span>'.format(hours, mins, secs))
+
+    def records_decoded_cb(self, f, records):
+        had_nodes = self.preview_nodes > 0
+
+        # carry the step on from the last chunk
+        start = -self.records_seen % self.PREVIEW_STEP
+        for vals in records[start::self.PREVIEW_STEP]:
+            if self.add_node(vals):
+                self.preview_nodes += 1
+        self.records_seen += len(records)
+
+        # show where the activity starts as soon as we know
+        if self.preview_nodes and not had_nodes:
+            nodes = self.layer.get_nodes()
+            self.view.set_zoom_level(15)
+            self.view.center_on(nodes[0].get_latitude(),
+                                nodes[0].get_longitude())
+
+        # and how far it's got
+        last = records[-1]
+        if 'distance' in last:
+            self.set_distance(last['distance'])
+
+        if 'timestamp' in last:
+            if self.first_timestamp is None:
+                self.first_timestamp = records[0].get('timestamp', last['timestamp'])
+            seconds = (last['timestamp'] - self.first_timestamp).total_seconds()
+            self.set_elapsed_time(*f.time_triplet(seconds))
 
-                self.upload_button.set_sensitive(False)
+    def activity_status_changed_cb(self, activity, status):
+        if status == Activity.Status.PARSED:
+            self.parsed()
+
+    def zoom_level_changed_cb(self, view, pspec):
+        # only once there's a route to show
+        if self.route:
+            self.show_route_level()
+
+    def fill_layer(self, zoom):
+        # adding nodes is slow so do it a frame's worth at a time to
+        # keep the main loop running. the old layer is shown until
+        # this one is done.
+        layer = Champlain.PathLayer()
+        lat, lon = self.route.level(zoom)
+        nodes = izip(lat.tolist(), lon.tolist())
+
+        def idle_cb():
+            deadline = time.time() + utils.FRAME_TIME
+            for lat, lon in nodes:
+                layer.add_node(Champlain.Coordinate.new_full(lat, lon))
+                if time.time() > deadline:
+                    return True
+
+            del self.filling[zoom]
+            self.layers[zoom] = layer
+            self.show_route_level()
+            return False
+
+        self.filling[zoom] = GLib.idle_add(idle_cb)
+
+    def show_route_level(self):
+        zoom = self.view.get_zoom_level()
+
+        # keep a layer for each zoom level we've been to
+        layer = self.layers.get(zoom)
+        if not layer:
+            if zoom not in self.filling:
+                self.fill_layer(zoom)
+            return
 
-            # end of status_changed_cb
+        if layer is self.layer:
+            return
 
-        if self.activity.status == Activity.Status.PARSED:
-            status_changed_cb(self.activity)
-        else:
-            self.activity.connect('status-changed', status_changed_cb)
-            self.activity.parse()
+        if self.layer:
+            self.view.remove_layer(self.layer)
+        self.view.add_layer(layer)
+        self.layer = layer
+
+    def route_loaded_cb(self, future):
+        # we might have moved on to another activity since
+        if future is not self.route_request:
+            return False
+        self.route_request = None
+
+        self.route = future.result()
+        if not self.route or not len(self.route):
+            self.route = None
+            self.embed.hide()
+            return False
+
+        # swap whatever was drawn while parsing for the route simplified
+        # to the current zoom level once it's ready
+        self.view.set_zoom_level(15)
+        self.show_route_level()
+
+        # https://bugzilla.gnome.org/show_bug.cgi?id=754718
+        # for some reason connecting to to ::realize on view
+        # or embed isn't enough. in fact this idle only works
+        # most of the time but for now it's good enough.
+        GLib.idle_add(self.ensure_route_visible, self.route)
+        return False
+
+    def ensure_route_visible(self, route):
+        if route is self.route:
+            south, west, north, east = route.bounds
+            bbox = Champlain.BoundingBox.new()
+            bbox.bottom, bbox.left, bbox.top, bbox.right = \
+                south, west, north, east
+            self.view.ensure_visible(bbox, False)
+        return False
+
+    def parsed(self):
+        activity = self.activity
+        f = activity.fit
+
+        # simplifying the route happens in a worker
+        self.route_request = activity.load_route()
+        self.route_request.add_done_callback(self.route_loaded_cb)
+
+        # now labels
+        self.set_distance(f.get_distance() / 1000)
+        self.set_elapsed_time(*f.get_elapsed_time())
+
+        elevation = f.get_elevation()
+        self.elevation_label.set_markup('{}m\n' \
+            '<span color="gray">Elevation</span>'.format(elevation))
+
+        hours, mins, secs = f.get_moving_time()
+        self.moving_time_label.set_markup('{0}:{1:02d}:{2:02d}\n' \
+            '<span color="gray">Moving Time</span>'.format(hours, mins, secs))
+
+        if activity.uploader is not None:
+            self.watch(activity.uploader, 'status-changed',
+                lambda *x: self.strava_id_updated_cb(None, None))
+
+            self.infobar.start(activity.uploader)
+            self.watch(self.infobar, 'response',
+                lambda *x: self.strava_id_updated_cb(None, None))
+
+            self.upload_button.set_sensitive(False)
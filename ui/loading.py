@@ -21,7 +21,8 @@ STATUSES = [ 'None',
              'Authentication',
              'Authentication Failed',
              'Connected',
-             'Disconnected']
+             'Disconnected',
+             'Failed to connect']
 
 class LoadingHeader(Gtk.HeaderBar):
     def __init__(self, page):
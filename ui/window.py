@@ -14,6 +14,8 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import time
+
 from gi.repository import Gtk
 
 import ant.fs.file
@@ -21,6 +23,7 @@ import ant.fs.file
 from ui.activities import Activities, ActivitiesHeader
 from ui.loading import Loading, LoadingHeader
 from ui.welcome import Welcome, WelcomeHeader
+import utils
 
 class Window(Gtk.ApplicationWindow):
     def __init__(self, app):
@@ -86,16 +89,50 @@ class Window(Gtk.ApplicationWindow):
         return page
 
     def next_clicked_cb(self, button):
-        self.next_page()
-        self.app.queue.get_file_list(self.get_file_list_cb)
+        # if we know what was on the device last time show that
+        # straight away and catch up with it in the background
+        start = time.time()
+        ant_files = self.app.queue.saved_file_list()
+        if ant_files is None:
+            self.next_page()
+            self.app.queue.get_file_list(self.get_file_list_cb)
+            return
+
+        # skip the loading page
+        self.current_page += 1
+        self.show_activities(ant_files)
+        utils.debug('window: showed saved listing in {:.1f}ms',
+            (time.time() - start) * 1000)
+
+        self.app.queue.get_file_list(self.reconcile_cb)
 
     def get_file_list_cb(self, ant_files):
+        # couldn't connect; the loading page says so
+        if ant_files is None:
+            return
+
+        self.show_activities(ant_files)
+
+    def show_activities(self, ant_files):
         page = self.next_page()
 
         for activity in ant_files[ant.fs.file.File.Identifier.ACTIVITY]:
             page.add_activity(activity)
         page.select_first()
         page.show_all()
+        page.parse_all()
+
+    def reconcile_cb(self, ant_files):
+        # nothing to do if it couldn't connect or we've gone back since
+        page = self.stack.get_visible_child()
+        if ant_files is None or not isinstance(page, Activities):
+            return
+
+        # only what's changed since the saved listing
+        activities = set(ant_files[ant.fs.file.File.Identifier.ACTIVITY])
+        changed = [antfile for antfile in ant_files.new + ant_files.changed
+                   if antfile in activities]
+        page.reconcile(changed, ant_files.removed)
 
     def back_clicked_cb(self, button):
         self.first_page()
@@ -15,8 +15,14 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import sys
+import time
 import errno
 import threading
+import traceback
+import multiprocessing
+from Queue import Queue
+from datetime import datetime, timedelta
 
 from gi.repository import GLib
 
@@ -29,6 +35,42 @@ def makedirs(path):
         else:
             raise
 
+# naive datetimes are all UTC
+EPOCH = datetime(1970, 1, 1)
+
+def to_timestamp(dt):
+    return (dt - EPOCH).total_seconds()
+
+def from_timestamp(seconds):
+    return EPOCH + timedelta(seconds=seconds)
+
+def parse_timestamp(value):
+    # how datetimes come back out of sqlite and used to be saved in
+    # fuga.ini; None if it's anything else
+    if not isinstance(value, basestring):
+        return None
+
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+
+    return None
+
+# FIT files are saved as <date>_<time>_<sub type>_<number>.fit
+FILENAME_DATE_FORMAT = '%Y-%m-%d_%H-%M-%S'
+
+def fit_filename(save_date, sub_type, number):
+    return '{0}_{1}_{2}.fit'.format(save_date.strftime(FILENAME_DATE_FORMAT),
+                                    sub_type, number)
+
+def parse_fit_filename(filename):
+    # (save date, sub type, number); ValueError if it's not one of ours
+    date, time, sub_type, number = os.path.splitext(filename)[0].split('_')
+    return (datetime.strptime(date + '_' + time, FILENAME_DATE_FORMAT),
+            int(sub_type), int(number))
+
 BYTES = 4096
 
 def read_stream_cb(stream, result, user_data):
@@ -47,9 +89,179 @@ def read_stream_async(stream, cb, data=''):
     stream.read_bytes_async(BYTES, GLib.PRIORITY_DEFAULT,
         callback=read_stream_cb, user_data=(cb, data))
 
-# http://amix.dk/blog/post/19346
-def run_in_thread(fn):
-    def run(*k, **kw):
-        t = threading.Thread(target=fn, args=k, kwargs=kw)
-        t.start()
-    return run
+class TimeoutError(Exception):
+    pass
+
+class Future(object):
+    # the result of a job run by a Pool; done callbacks are called in
+    # the main loop
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.value = None
+        self.error = None
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise TimeoutError()
+        if self.error:
+            raise self.error
+        return self.value
+
+    def add_done_callback(self, cb):
+        with self.lock:
+            if not self.done():
+                self.callbacks.append(cb)
+                return
+        GLib.idle_add(cb, self)
+
+    def set_result(self, value, error=None):
+        with self.lock:
+            self.value = value
+            self.error = error
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+
+        for cb in callbacks:
+            GLib.idle_add(cb, self)
+
+class Pool(object):
+    # a few worker threads for each kind of job so lots of jobs don't
+    # mean lots of threads fighting over the GIL
+
+    LIMITS = {
+        # only ever talk to one device at once
+        'device': 1,
+        'parse': multiprocessing.cpu_count(),
+        'default': 4,
+    }
+
+    def __init__(self, limits=LIMITS):
+        self.limits = limits
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.threads = {}
+        self.idle = {}
+
+        # stats
+        self.completed = dict.fromkeys(limits, 0)
+        self.wait_time = dict.fromkeys(limits, 0.0)
+        self.max_wait_time = dict.fromkeys(limits, 0.0)
+
+    def submit(self, kind, fn, *args, **kwargs):
+        future = Future()
+
+        with self.lock:
+            if kind not in self.queues:
+                self.queues[kind] = Queue()
+                self.threads[kind] = []
+                self.idle[kind] = 0
+
+            queue = self.queues[kind]
+            queue.put((fn, args, kwargs, future, time.time()))
+
+            # start another worker if there's more waiting than idle ones
+            # to take it
+            threads = self.threads[kind]
+            if queue.qsize() > self.idle[kind] and \
+               len(threads) < self.limits[kind]:
+                t = threading.Thread(target=self.worker, args=(kind,))
+                t.daemon = True
+                threads.append(t)
+                # it'll take one as soon as it's started
+                self.idle[kind] += 1
+                t.start()
+
+        return future
+
+    def worker(self, kind):
+        queue = self.queues[kind]
+
+        while True:
+            fn, args, kwargs, future, submitted = queue.get()
+
+            waited = time.time() - submitted
+            with self.lock:
+                self.idle[kind] -= 1
+                self.wait_time[kind] += waited
+                self.max_wait_time[kind] = max(self.max_wait_time[kind],
+                                               waited)
+
+            debug('pool: {} job waited {:.1f}ms, {} still queued',
+                kind, waited * 1000, queue.qsize())
+
+            try:
+                value = fn(*args, **kwargs)
+            except Exception as e:
+                traceback.print_exc()
+                value, error = None, e
+            else:
+                error = None
+
+            with self.lock:
+                self.completed[kind] += 1
+                self.idle[kind] += 1
+
+            future.set_result(value, error)
+
+pool = Pool()
+
+def run_in_pool(kind):
+    def decorator(fn):
+        def run(*k, **kw):
+            return pool.submit(kind, fn, *k, **kw)
+        return run
+    return decorator
+
+run_in_thread = run_in_pool('default')
+
+def format_time_left(seconds):
+    # '' if it's not known
+    if seconds < 0:
+        return ''
+    if seconds < 60:
+        return 'less than a minute left'
+
+    minutes = int(round(seconds / 60.0))
+    return '{} minute{} left'.format(minutes, '' if minutes == 1 else 's')
+
+def debug(fmt, *args):
+    if 'FUGA_DEBUG' in os.environ:
+        sys.stderr.write(fmt.format(*args) + '\n')
+
+# how long the main loop can be busy before it's noticeable
+FRAME_TIME = 1.0 / 60
+
+class StallMonitor(object):
+    # notices when the main loop is busy for longer than a frame
+
+    INTERVAL = 10 # ms
+
+    def __init__(self):
+        self.last = None
+
+        # stats
+        self.stalls = 0
+        self.max_stall = 0.0
+
+    def start(self):
+        self.last = time.time()
+        GLib.timeout_add(self.INTERVAL, self.timeout_cb)
+
+    def timeout_cb(self):
+        now = time.time()
+        stall = now - self.last - self.INTERVAL / 1000.0
+        self.last = now
+
+        if stall > FRAME_TIME:
+            self.stalls += 1
+            self.max_stall = max(self.max_stall, stall)
+            debug('mainloop: stalled for {:.1f}ms (worst {:.1f}ms, {} stalls)',
+                stall * 1000, self.max_stall * 1000, self.stalls)
+
+        return True